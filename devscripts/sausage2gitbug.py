@@ -19,114 +19,277 @@
 
 import argparse
 import base64
+import collections
+import concurrent.futures
+import contextlib
 from dataclasses import dataclass
-import dateutil.parser
+import datetime
 import functools
+import gzip
+import heapq
+import itertools
 import json
+import operator
 import os
+import queue
+import re
 import subprocess
-from tqdm import tqdm
+import sys
 import tempfile
+import threading
+from tqdm import tqdm
 
-print('this uses xloem\'s fork of git-bug that lets manual details be supplied')
-print('https://github.com/xloem/git-bug/tree/manual-details\n')
+try:
+	# much faster on the gharchive lines, and takes bytes directly
+	from orjson import loads as jsonloads
+except ImportError:
+	from json import loads as jsonloads
+try:
+	# C parser, far faster than dateutil
+	from ciso8601 import parse_datetime as isoparse
+except ImportError:
+	if sys.version_info >= (3, 11):
+		# takes Z and -0800 offsets itself
+		isoparse = datetime.datetime.fromisoformat
+	else:
+		def isoparse(item):
+			return datetime.datetime.fromisoformat(item.replace('Z', '+00:00'))
 
+legacytimetable = str.maketrans('/', '-')
+# events in the same hour share few distinct timestamps
+@functools.lru_cache(maxsize=65536)
 def parsedate(item):
-	return dateutil.parser.isoparse(item.replace('/','-').replace(' -','-').replace(' +','+'))
+	if '/' in item:
+		# older events have times like 2012/03/10 14:32:11 -0800
+		if len(item) == 25 and item[19] == ' ':
+			# always laid out the same, so it is rebuilt from slices in one go,
+			# with the offset colon every parser accepts
+			return isoparse(f'{item[:4]}-{item[5:7]}-{item[8:19]}{item[20:23]}:{item[23:]}')
+		item = item.translate(legacytimetable).replace(' -', '-').replace(' +', '+')
+		if item[-5] in '-+' and isoparse is not datetime.datetime.fromisoformat:
+			# ciso8601, and fromisoformat before python 3.11, want the offset as -08:00
+			item = item[:-2] + ':' + item[-2:]
+	return isoparse(item)
+githubidprefixes = {type: type.encode() for type in ('04:User', '05:Issue', '012:IssueComment')}
+# the same actors and issues recur constantly
+@functools.lru_cache(maxsize=1<<20)
 def id2githubid(type, id):
-	return base64.b64encode(bytes(type + str(id), 'utf-8')).decode()
+	prefix = githubidprefixes.get(type) or type.encode()
+	return base64.b64encode(prefix + str(id).encode()).decode()
 
-class string2tempfn:
-	def __init__(self, data):
-		with tempfile.NamedTemporaryFile('w',delete=False) as file:
-			file.write(data)
-			self.filename = file.name
-	def __enter__(self):
-		return self.filename
-	def __exit__(self, *args):
-		os.remove(self.filename)
+def prefetch(iterable, count):
+	# runs iterable in a thread, up to count items ahead of the consumer,
+	# so producing items overlaps with waiting on git-bug
+	items = queue.Queue(maxsize=count)
+	done = object()
+	def produce():
+		try:
+			for item in iterable:
+				items.put((item, None))
+		except BaseException as exception:
+			items.put((done, exception))
+		else:
+			items.put((done, None))
+	threading.Thread(target=produce, daemon=True).start()
+	while True:
+		item, exception = items.get()
+		if item is done:
+			if exception is not None:
+				raise exception
+			return
+		yield item
+
+def tracked(events, progress, step = 0.01):
+	# progress is only passed on to tqdm in steps of a hundredth of a file,
+	# rather than locking and redrawing it for every event
+	shown = fileprogress = progress.n
+	for event in events:
+		yield event
+		fileprogress = event['fileprogress']
+		if fileprogress - shown >= step:
+			progress.update(fileprogress - shown)
+			shown = fileprogress
+	if fileprogress != shown:
+		progress.update(fileprogress - shown)
 
 class EventsDir:
 	def __init__(self, dir):
 		self.dir = dir
-		self.filenames = [*os.listdir(self.dir)]
+		# gharchive hours aren't zero-padded, so compare the numbers in names as numbers
+		entries = sorted(os.scandir(self.dir), key = lambda entry: tuple(
+			int(part) if part.isdigit() else part
+			for part in re.split(r'(\d+)', entry.name)
+		))
+		self.filenames = [entry.name for entry in entries]
+		self.filesizes = [entry.stat().st_size for entry in entries]
 		if len(self.filenames):
 			print('WARNING: this is just a work in progress and may make new issues and users in your git-bug repository every time it is run.')
-		self.filenames.sort()
 		self.filecount = len(self.filenames)
+		# compressed hours are kept decompressed here, so their lines can be read back by offset
+		self.spill = tempfile.TemporaryDirectory(prefix='sausage2gitbug-')
+		# fds of recently read files, by name, least recently used first
+		self.rawfiles = collections.OrderedDict()
+		# readbugs reads lines back on the prefetch thread while the importers also do;
+		# held until the pread is done, so an eviction can't close an fd in use
+		self.rawlock = threading.Lock()
 	def __iter__(self):
+		return prefetch(self.events(), 1024)
+	def events(self):
 		lastevent = None
 		filenum = 0
 		# so we take two files
 		# sort them together
 		# and then process only 1 file's length
+		# whatever isn't processed is carried over to be sorted with the next file,
+		# so each file is only read and parsed once
+		sortkey = operator.itemgetter('sortkey')
+		files = self.readfiles()
+		carried = []
 		for filename, nextfilename in zip(self.filenames, (*self.filenames[1:],None)):
 			# two files are sorted together
 			# and then only data equivalent in length to the first file kept
 			# this is a way to handle things possibly being out of order
-			filenames = [filename]
+			if filenum == 0:
+				carried = next(files)
+				carried.sort(key = sortkey)
+			# what's carried over is always as long as the current file
+			eventcount = len(carried)
 			if nextfilename:
-				filenames.append(nextfilename)
-			eventcount = 0
-			events = []
-			for filename in filenames:
-				import itertools
-				with open(os.path.join(self.dir,filename), 'rb') as file:
-					events.extend([
-						{
-							'json': line[:-1].decode('utf-8'),
-							'fileref': (filename, adjustedoffset - len(b'{}')),
-							**json.loads(line)
-						} for adjustedoffset, line in
-							itertools.accumulate(file.readlines(), lambda last, next: (last[0] + len(last[1]), next), initial=(0,b'{}'))
-					][1:])
-				if eventcount == 0:
-					eventcount = len(events)
-			def eventcmp(a, b):
-				if 'id' in a and 'id' in b:
-					a, b = (int(e['id']) for e in (a, b))
-				else:
-					a, b = (parsedate(e['created_at']) for e in (a, b))
-				return (a > b) - (a < b)
-			events.sort(key = functools.cmp_to_key(eventcmp))
-			events = events[:eventcount]
+				# the carried events are already in order; sort the new file alone and merge them
+				nextevents = next(files)
+				nextevents.sort(key = sortkey)
+				events = heapq.merge(carried, nextevents, key = sortkey)
+			else:
+				events = iter(carried)
 
 			eventnum = 0
-			for event in events:
+			# progress is counted in exact thousandths of a file, with integers
+			filethousandths = filenum * 1000
+			for event in itertools.islice(events, eventcount):
 				eventnum += 1
-				self.mutate_event(event)
 				if lastevent is not None:
-					if eventcmp(event, lastevent) < 0:
+					if event['sortkey'] < lastevent['sortkey']:
 						raise AssertionError('out of order events', filename, 'previous:', (lastevent['id'],lastevent['created_at']), 'now:', (event['id'],event['created_at']))
-				event['fileprogress'] = int((filenum + eventnum / eventcount)*1000)/1000
+				event['fileprogress'] = (filethousandths + eventnum * 1000 // eventcount) / 1000
 				yield event
 				lastevent = event
+			carried = [*events]
 			filenum += 1
+	def readfiles(self):
+		# files are parsed and mutated in worker processes, a few ahead of
+		# where they're needed; only merging and importing happen here
+		with concurrent.futures.ProcessPoolExecutor() as executor:
+			files = zip(self.filenames, self.filesizes)
+			pending = collections.deque(
+				executor.submit(EventsDir.readfile, self.dir, filename, size)
+				for filename, size in itertools.islice(files, os.cpu_count() + 1)
+			)
+			while pending:
+				events = pending.popleft().result()
+				for filename, size in itertools.islice(files, 1):
+					pending.append(executor.submit(EventsDir.readfile, self.dir, filename, size))
+				yield events
+	@staticmethod
+	def readfile(dir, filename, size):
+		# the raw line isn't kept, only where it is; see rawjson
+		# the whole file is read with one call into a buffer of its known size
+		# gharchive serves hours gzipped; those are decompressed in one go instead,
+		# and offsets then refer to the decompressed text, which rawjson spills once when first needed
+		with open(os.path.join(dir, filename), 'rb') as file:
+			if filename.endswith('.gz'):
+				data = gzip.decompress(file.read())
+				size = len(data)
+			else:
+				data = bytearray(size)
+				size = file.readinto(data)
+		events = []
+		offset = 0
+		while offset < size:
+			end = data.find(b'\n', offset, size)
+			if end < 0:
+				end = size
+			if end > offset:
+				event = jsonloads(data[offset:end])
+				event['fileref'] = (filename, offset, end - offset)
+				EventsDir.mutate_event(event)
+				events.append(event)
+			offset = end + 1
+		return events
+	@staticmethod
+	def spillfile(spilldir, filename, data):
+		# written under a temporary name, so a half-written spill is never read
+		path = os.path.join(spilldir, filename[:-len('.gz')])
+		with open(path + '.part', 'wb') as file:
+			file.write(data)
+		os.replace(path + '.part', path)
+		return path
+	# bugs are imported one at a time and each bug's events span many hours,
+	# so this is sized for that rather than for the two-file sort window
+	maxrawfiles = 64
+	def rawjson(self, fileref):
+		# reads an event's original line back, for storing verbatim in git-bug
+		filename, offset, length = fileref
+		with self.rawlock:
+			raw = self.rawfiles.get(filename)
+			if raw is None:
+				while len(self.rawfiles) >= self.maxrawfiles:
+					os.close(self.rawfiles.popitem(last = False)[1])
+				if filename.endswith('.gz'):
+					path = os.path.join(self.spill.name, filename[:-len('.gz')])
+					if not os.path.exists(path):
+						with gzip.open(os.path.join(self.dir, filename), 'rb') as file:
+							path = self.spillfile(self.spill.name, filename, file.read())
+				else:
+					path = os.path.join(self.dir, filename)
+				raw = os.open(path, os.O_RDONLY)
+				self.rawfiles[filename] = raw
+			else:
+				self.rawfiles.move_to_end(filename)
+			return os.pread(raw, length, offset)
 	def from_fileref(self, fileref):
-		with open(os.path.join(self.dir, fileref[0])) as file:
-			file.seek(fileref[1])
-			line = file.readline()
-			event = {'json': line[:-1], 'fileref': fileref, **json.loads(line)}
-			self.mutate_event(event)
-			return event
-	def mutate_event(self, event):
+		event = jsonloads(self.rawjson(fileref))
+		event['fileref'] = fileref
+		self.mutate_event(event)
+		return event
+	eventfields = frozenset(('type', 'actor', 'payload', 'created_at', 'id', 'url', 'fileref'))
+	payloadfields = frozenset(('action', 'issue', 'comment', 'number', 'issue_id', 'pull_request'))
+	@staticmethod
+	def mutate_event(event):
 		if 'actor_attributes' in event:
 			event['actor'] = event['actor_attributes']
 			del event['actor_attributes']
 		# payload issue has a 'user' field sometimes, which contains node_id of user
 		# it could be merged with actor to get node_id, dunno
-		event['actor'] = self.translate_actor(event['actor'])
+		event['actor'] = EventsDir.translate_actor(event['actor'])
+		# these few strings repeat across nearly every event
+		event['type'] = sys.intern(event['type'])
+		actor = event['actor']
+		if 'login' in actor:
+			actor['login'] = sys.intern(actor['login'])
 		if 'payload' in event:
-			event['payload'] = self.translate_payload(event['payload'])
-		if 'repo' in event:
-			del event['repo']
-		if 'repository' in event:
-			del event['repository']
+			event['payload'] = EventsDir.translate_payload(event['payload'])
+		# everything else is dropped early, so it isn't carried through
+		# the worker pickles, the sort window, and the import
+		for key in event.keys() - EventsDir.eventfields:
+			del event[key]
+		if 'payload' in event:
+			payload = event['payload']
+			for key in payload.keys() - EventsDir.payloadfields:
+				del payload[key]
+			if isinstance(payload.get('action'), str):
+				payload['action'] = sys.intern(payload['action'])
 		event['created_at_datetime'] = parsedate(event['created_at'])
-	def translate_actor(self, actor):
+		# newer events are ordered by id, older ones that have none by time;
+		# the older ones come first, since the format without ids predates the one with them
+		if 'id' in event:
+			event['sortkey'] = (1, int(event['id']))
+		else:
+			event['sortkey'] = (0, event['created_at_datetime'].timestamp())
+	@staticmethod
+	def translate_actor(actor):
+		# the event owns its dicts, so they're filled in place rather than copied
 		if not isinstance(actor, dict):
 			return { 'login': 'actor' }
-		actor = {**actor}
 		if 'node_id' not in actor and 'id' in actor:
 			actor['node_id'] = id2githubid('04:User', actor['id'])
 		if not 'avatar_url' in actor:
@@ -135,8 +298,8 @@ class EventsDir:
 			else:
 				actor['avatar_url'] = ''
 		return actor
-	def translate_payload(self, payload):
-		payload = {**payload}
+	@staticmethod
+	def translate_payload(payload):
 		if 'issue' in payload and isinstance(payload['issue'], dict):
 			issue = payload['issue']
 			if 'number' not in issue and 'number' in payload:
@@ -150,39 +313,92 @@ class EventsDir:
 			
 		return payload
 
-def run(cmd, *args, replies = None, path = None):
-	try:
-		proc = subprocess.Popen([*cmd.split(' '), *(str(arg) for arg in args)], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, cwd=path)
-	except Exception as e:
-		print(cmd, *args)
-		raise e
-	while replies and len(replies):
-		key = bytes(next(iter(replies)), 'utf-8')
-		buf = proc.stdout.read(len(key))
-		while buf != key:
-			print(buf, key)
-			buf = buf[1:] + proc.stdout.read(1)
-		key = key.decode()
-		value = replies[key]
-		proc.stdin.write(bytes(value + '\n', 'utf-8'))
-		proc.stdin.flush()
-		print(buf.decode(), value)
-		del replies[key]
-	for line in proc.stdout:
-		if proc.poll():
-			break
-		yield line[:-1].decode()
-	if proc.wait():
-		print(proc.stdout.read().decode())
-		raise subprocess.CalledProcessError(proc.returncode, proc.args)
-
-parser = argparse.ArgumentParser()
-parser.add_argument("dir", help="folder containing only gharchive newline-delimited .json files")
-args = parser.parse_args()
-events = EventsDir(args.dir)
-	
-
-@dataclass
+class GitBugClient:
+	# every git-bug operation goes through here, so that repeated queries can
+	# be folded together and process spawning is kept in one place.
+	# git-bug has no batch/daemon mode, so each call is still its own process.
+	def __init__(self, path = None):
+		if path is None:
+			path = os.curdir
+		self.path = path
+		self.fds = set()
+	@contextlib.contextmanager
+	def pipe(self, data):
+		# hands data to git-bug as a /dev/fd path rather than writing and
+		# removing a temporary file
+		if isinstance(data, str):
+			data = data.encode()
+		if hasattr(os, 'memfd_create'):
+			# an anonymous in-memory file: written once here, no feeder thread,
+			# and git-bug can read it as often as it likes
+			read = os.memfd_create('gharchive', 0)
+			# through a file object, which keeps writing past short writes
+			with open(read, 'wb', closefd = False) as file:
+				file.write(data)
+		else:
+			# fed from a thread
+			read, write = os.pipe()
+			def feed():
+				try:
+					with open(write, 'wb') as file:
+						file.write(data)
+				except BrokenPipeError:
+					# git-bug exited without reading it
+					pass
+			threading.Thread(target=feed, daemon=True).start()
+		self.fds.add(read)
+		try:
+			yield '/dev/fd/' + str(read)
+		finally:
+			self.fds.remove(read)
+			os.close(read)
+	def call(self, cmd, *args, replies = None, decode = True):
+		try:
+			proc = subprocess.Popen(['git', 'bug', *cmd.split(' '), *(str(arg) for arg in args)], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, bufsize=65536, cwd=self.path, pass_fds=tuple(self.fds))
+		except Exception as e:
+			print('git bug', cmd, *args)
+			raise e
+		while replies and len(replies):
+			key = bytes(next(iter(replies)), 'utf-8')
+			# scan what's already buffered for the prompt, and consume only up to its end
+			seen = bytearray()
+			while True:
+				data = proc.stdout.peek()
+				if not data:
+					raise EOFError('git bug exited before prompting', key)
+				start = max(len(seen) - len(key) + 1, 0)
+				index = (seen[start:] + data).find(key)
+				if index >= 0:
+					seen += proc.stdout.read(start + index + len(key) - len(seen))
+					break
+				seen += proc.stdout.read(len(data))
+			if len(seen) > len(key):
+				print(bytes(seen[:-len(key)]), key)
+			key = key.decode()
+			value = replies[key]
+			proc.stdin.write(bytes(value + '\n', 'utf-8'))
+			proc.stdin.flush()
+			print(key, value)
+			del replies[key]
+		# large reads; the exit status is only checked once output ends,
+		# rather than polling the process for every line.
+		# the last few lines are kept, so a failure can show git-bug's whole error
+		tail = collections.deque(maxlen = 32)
+		for line in iter(proc.stdout.readline, b''):
+			tail.append(line)
+			yield line[:-1].decode() if decode else line
+		if proc.wait():
+			print(b''.join(tail).decode(), end = '')
+			raise subprocess.CalledProcessError(proc.returncode, proc.args)
+	def run(self, cmd, *args):
+		# runs to completion, keeping only the last line of output (where git-bug prints new ids)
+		lines = collections.deque(self.call(cmd, *args), maxlen = 1)
+		return lines[0] if lines else None
+	def json(self, cmd, *args):
+		# the raw lines are joined as bytes and parsed in one go, without decoding each
+		return jsonloads(b''.join(self.call(cmd, *args, decode = False)))
+
+@dataclass(slots=True)
 class User:
 	login : str
 	fullname : str
@@ -192,7 +408,7 @@ class User:
 	githubid : str
 	hash : str = None
 
-@dataclass
+@dataclass(slots=True)
 class Bug:
 	title : str
 	body : str
@@ -205,7 +421,7 @@ class Bug:
 	hash : str = None
 	modtime : int = 0
 
-@dataclass
+@dataclass(slots=True)
 class StatusChange:
 	status : str
 	bug : str
@@ -213,52 +429,70 @@ class StatusChange:
 	hash : str = None
 
 class Users:
-	def __init__(self, path = None):
-		if path is None:
-			path = os.curdir
-		self.path = path
+	def __init__(self, client):
+		self.client = client
 		self.namemappings = {}
-		userlines = run('git bug user ls', path = self.path)
-		# there's a bug here where 2 bogus users are read on first
-		# run.  haven't looked at it.
-		#   this is likely output from clearing locks and building caches.
-		#   throwing out improper lines might fix it
-		userlines = [*userlines]
-		if len(userlines) == 2:
-			print('is this the bug?', userlines)
-		for line in tqdm(userlines, "Mapping imported users", unit='user'):
-			hash, name = line.split(' ', 1)
-			if name[-1] == ')':
-				login = name.split('(')[-1][:-1]
-			else:
-				login = name
+		self.adopted = None
+		# fully-built users, so lookups don't need to shell out
+		self.cache = {}
+		users = self.client.json('user ls', '--format', 'json')
+		for user in tqdm(users, "Mapping imported users", unit='user'):
+			# the same object then keys both maps
+			login = sys.intern(user.get('login') or user['name'])
 			if login in self.namemappings:
-				print(line)
+				print(user)
 				raise KeyError('duplicate user', login)
-			self.namemappings[login] = hash
+			self.namemappings[login] = user['id']
+			metadata = user.get('metadata') or {}
+			if 'gharchive-json' in metadata and 'github-id' in metadata:
+				self.cache[login] = User(
+					login,
+					user['name'],
+					user.get('email', ''),
+					user.get('avatar_url', ''),
+					metadata['gharchive-json'],
+					metadata['github-id'],
+					user['id']
+				)
 	def adopt(self, user):
-		if user in self:
-			user = self[user]
-		run('git bug user adopt', user.hash, path = self.path)
+		if isinstance(user, User):
+			user = user.hash
+		else:
+			# a login, or already a hash
+			user = self.namemappings.get(user, user)
+		# consecutive events are often by the same user; adopting is a whole git-bug run
+		if user == self.adopted:
+			return
+		self.client.run('user adopt', user)
+		self.adopted = user
+	def get(self, login, default = None):
+		user = self.cache.get(login)
+		if user is None and login in self.namemappings:
+			user = self[login]
+		return default if user is None else user
 	def __getitem__(self, login):
 		if login is None:
 			login = 'unknown'
 			if login not in self.namemappings:
 				self[login] = User(login, 'Unknown User', 'unknown@localhost.localdomain', '', {})
+		if login in self.cache:
+			return self.cache[login]
 		hash = self.namemappings[login]
-		metadata = [*run('git bug user --field metadata', hash, path = self.path)]
-		metadata = {k:v for k,v in zip(metadata[0::2],metadata[1::2])}
+		# one call for all the fields, rather than one per --field
+		user = self.client.json('user', hash, '--format', 'json')
+		metadata = user['metadata']
 		if 'gharchive-json' not in metadata or 'github-id' not in metadata:
 			raise Exception('missing field in metadata',login,metadata)
 		user = User(
-			*run('git bug user --field login', hash, path = self.path),
-			*run('git bug user --field name', hash, path = self.path),
-			*run('git bug user --field email', hash, path = self.path),
-			*run('git bug user --field avatarUrl', hash, path = self.path),
+			user['login'],
+			user['name'],
+			user['email'],
+			user['avatar_url'],
 			metadata['gharchive-json'],
 			metadata['github-id'],
-			*run('git bug user --field id', hash, path = self.path)
+			user['id']
 		)
+		self.cache[login] = user
 		return user
 	def __contains__(self, login):
 		"""you can also get the login information using the github api
@@ -273,19 +507,20 @@ class Users:
 		if not user.githubid:
 			raise Except('nogihubid', user)
 		if not user.hash:
-			with string2tempfn(user.json) as jsonfilename:
-				user.hash = [*run(
-					'git bug user create',
+			with self.client.pipe(user.json) as jsonfilename:
+				user.hash = self.client.run(
+					'user create',
 					'--login', user.login,
 					'--name', user.fullname,
 					'--email', user.email,
 					'--avatar', user.avatar,
 					'--metadata', 'github-login=' + user.login,
 					'--metadata', 'github-id=' + user.githubid,
-					'--metadatafile', 'gharchive-json=' + jsonfilename,
-					path = self.path
-				)][-1]
-		self.namemappings[user.login] = user.hash
+					'--metadatafile', 'gharchive-json=' + jsonfilename
+				)
+		login = user.login = sys.intern(user.login)
+		self.namemappings[login] = user.hash
+		self.cache[login] = user
 
 # the plan is to import the bugs in order.
 # each event is associated with a bug.
@@ -298,27 +533,27 @@ class Users:
 # so a map of bug id to file and line number array
 
 class Bugs:
-	@dataclass
+	@dataclass(slots=True)
 	class gitbugmapping:
 		hash : str
 		lamport : int = -1
-	def __init__(self, events, path = None):
-		if path is None:
-			path = os.curdir
-		self.path = path
+	def __init__(self, events, client):
+		self.client = client
 		self.bugmappings = {}
 		# likely to be too slow?  oh because all the json is together, loaded into memory in python .. hmm ...
-		bugs = json.loads('\n'.join(run('git bug ls --format json', path = self.path)))
+		bugs = self.client.json('ls', '--format', 'json')
 		for bug in tqdm(bugs, "Mapping imported bugs", unit='bug'):
 			hash = bug['id']
 			lamport = bug['edit_time']['lamport']
 			urlparts = bug['metadata']['github-url'].split('/')
 			number = int(urlparts[-1])
 			self.bugmappings[number] = Bugs.gitbugmapping(hash, lamport)
+		# bugs read back from git-bug, by hash; kept current as they are changed
+		self.cache = {}
 		self.bugcache = {}
 		idtonumber = {}
 		with tqdm(total=events.filecount,desc='caching bug locations',unit='file') as progress:
-			for event in events:
+			for event in tracked(events, progress):
 				number = -1
 				if event['type'] in ('WatchEvent', 'ForkEvent', 'PushEvent', 'CreateEvent', 'CommitCommentEvent', 'MemberEvent', 'DownloadEvent', 'DeleteEvent', 'ReleaseEvent'):
 					number = 'NonBug'
@@ -333,8 +568,8 @@ class Bugs:
 						if 'number' in issue:
 							number = issue['number']
 							idtonumber[issue['id']] = number
-					elif 'issue_id' in payload and payload['issue_id'] in idtonumber:
-						number = idtonumber[payload['issue_id']]
+					elif 'issue_id' in payload:
+						number = idtonumber.get(payload['issue_id'], -1)
 				if number == -1 and 'url' in event:
 					url = event['url']
 					if '#' in url:
@@ -346,20 +581,27 @@ class Bugs:
 				if number == -1:
 					del event['created_at_datetime']
 					raise Exception(json.dumps(event, indent=2))
-				if number not in self.bugcache:
-					self.bugcache[number] = []
-				self.bugcache[number].append(event['fileref'])
-				progress.update(event['fileprogress'] - progress.n)
+				self.bugcache.setdefault(number, []).append(event['fileref'])
 
 	#def lamport(self, bug):
 	#	return self.bugmappings[bug].lamport
-	def doevent(self, bug, user, time, event, githuburl, json, githubid, body = ''):
-		if bug in self.bugmappings:
-			bug = self.bugmappings[bug].hash
+	def hash(self, bug):
 		if isinstance(bug, Bug):
-			bug = bug.hash
+			return bug.hash
+		mapping = self.bugmappings.get(bug)
+		return bug if mapping is None else mapping.hash
+	bugstatuses = {'open': 'open', 'close': 'closed', 'closed': 'closed'}
+	def changed(self, hash, time, status = None):
+		# a bug read back earlier is brought up to date rather than read again
+		bug = self.cache.get(hash)
+		if bug is not None:
+			bug.modtime = max(bug.modtime, time)
+			if status is not None:
+				bug.status = Bugs.bugstatuses[status]
+	def doevent(self, bug, user, time, event, githuburl, json, githubid, body = ''):
+		bug = self.hash(bug)
 		usermap.adopt(user)
-		with string2tempfn(json) as jsonfilename, string2tempfn(body) as bodyfilename:
+		with self.client.pipe(json) as jsonfilename, self.client.pipe(body) as bodyfilename:
 			metadata = [
 				'--time', time,
 				'--metadata', 'github-url=' + githuburl,
@@ -368,74 +610,77 @@ class Bugs:
 				'--metadatafile', 'gharchive-json=' + jsonfilename
 			]
 			if event == 'open' or event == 'close':
-				run(
-					'git bug status', event,
+				self.client.run(
+					'status', event,
 					*metadata,
-					bug,
-					path = self.path
+					bug
 				)
+				self.changed(bug, time, event)
 			else:
 				raise Exception('unknown', event)
 	def setstatus(self, bug, time, status, json):
-		if bug in self.bugmappings:
-			bug = self.bugmappings[bug].hash
-		if isinstance(bug, Bug):
-			bug = bug.hash
-		with string2tempfn(json) as jsonfilename:
-			run(
-				'git bug status', status,
+		bug = self.hash(bug)
+		with self.client.pipe(json) as jsonfilename:
+			self.client.run(
+				'status', status,
 				bug,
 				'--time', time,
-				'--metadatafile', 'gharchive-json=' + jsonfilename,
-				path = self.path
+				'--metadatafile', 'gharchive-json=' + jsonfilename
 			)
+		self.changed(bug, time, status)
 	def addcomment(self, bug, time, message, githubid, githuburl, json):
-		if bug in self.bugmappings:
-			bug = self.bugmappings[bug]
-		if isinstance(bug, Bug):
-			bug = bug.hash
-		with string2tempfn(json) as jsonfilename, string2tempfn(message) as messagefilename:
-			run(
-				'git bug comment add',
+		bug = self.hash(bug)
+		with self.client.pipe(json) as jsonfilename, self.client.pipe(message) as messagefilename:
+			self.client.run(
+				'comment add',
 				bug,
 				'--time', time,
 				'--file', messagefilename,
 				'--metadata', 'github-url=' + githuburl,
 				'--metadata', 'github-id=' + githubid,
 				'--metadata', 'origin=github',
-				'--metadatafile', 'gharchive-json=' + jsonfilename,
-				path = self.path
+				'--metadatafile', 'gharchive-json=' + jsonfilename
 			)
+		self.changed(bug, time)
 	def __getitem__(self, number):
 		bug = self.bugmappings[number]
 		hash, lamport = bug.hash, bug.lamport
-		bug = json.loads('\n'.join(run('git bug show --format json', hash, path = self.path)))
-		metadata = [*run('git bug show --field creationMetadata', hash, path = self.path)]
-		metadata = {k:v for k,v in zip(metadata[0::2],metadata[1::2])}
+		if hash in self.cache:
+			return self.cache[hash]
+		# the creation metadata comes with the rest, as it does for 'ls'
+		bug = self.client.json('show', '--format', 'json', hash)
+		metadata = {**bug['metadata']}
 		if not 'github-id' in metadata:
 			metadata['github-id'] = None
-		return Bug(
+		# authors and statuses repeat across many bugs
+		bug = Bug(
 			bug['title'],
 			bug['comments'][0]['message'],
-			bug['author']['id'],
+			sys.intern(bug['author']['id']),
 			bug['create_time']['timestamp'],
-			bug['status'],
+			sys.intern(bug['status']),
 			metadata['github-url'],
 			metadata['gharchive-json'],
 			metadata['github-id'],
 			bug['id'],
 			bug['edit_time']['timestamp']
 		)
+		self.cache[hash] = bug
+		return bug
 	def __contains__(self, number):
 		return number in self.bugmappings
+	def get(self, number, default = None):
+		if number not in self.bugmappings:
+			return default
+		return self[number]
 	def __setitem__(self, number, bug):
 		if number in self.bugmappings:
 			raise KeyError('duplicate bug', bug)
 		if not bug.hash:
 			usermap.adopt(bug.user)
-			with string2tempfn(bug.json) as jsonfilename, string2tempfn(bug.body) as bodyfilename:
+			with self.client.pipe(bug.json) as jsonfilename, self.client.pipe(bug.body) as bodyfilename:
 				args = [
-					'git bug add',
+					'add',
 					'--title', bug.title,
 					'--file', bodyfilename,
 					'--time', int(bug.time.timestamp()),
@@ -444,14 +689,11 @@ class Bugs:
 					'--metadata', 'origin=github',
 					'--metadatafile', 'gharchive-json=' + jsonfilename,
 				]
-				bug.hash = [*run(
-					*args,
-					path = self.path
-				)][-1].split(' ',1)[0]
-		self.bugmappings[number] = bug.hash
-
-usermap = Users()
-bugmap = Bugs(events)
+				bug.hash = self.client.run(
+					*args
+				).split(' ',1)[0]
+		self.bugmappings[number] = Bugs.gitbugmapping(bug.hash)
+
 #issuemap = {}
 eventmap = {}
 
@@ -461,50 +703,72 @@ eventmap = {}
 # this just scrapes the actor field for users right now.  add more fields as needed.
 
 def importusers(events):
-	with tqdm(total=events.filecount,desc='json files, new user details',unit='file') as progress:
-		for event in events:
-			actor = event['actor']
-			login = actor['login']
-			if login not in usermap:
-				if 'name' in actor and 'email' in actor and 'node_id' in actor:
-					usermap[login] = User(
-						login,
-						actor['name'],
-						actor['email'],
-						actor['avatar_url'],
-						event['json'],
-						actor['node_id']
-					)
-			progress.update(event['fileprogress'] - progress.n)
-	with tqdm(total=events.filecount,desc='json files, new user summaries',unit='file') as progress:
-		for event in events:
+	# one pass over the events finds, for each new login, the first actor with full details
+	# and the first with at least a node id; users without full details get the summary
+	known = usermap.__contains__
+	details = {}
+	summaries = {}
+	with tqdm(total=events.filecount,desc='json files, new users',unit='file') as progress:
+		for event in tracked(events, progress):
 			actor = event['actor']
 			login = actor['login']
-			if login not in usermap and len(actor) > 1:
-				if 'name' not in actor:
-					actor['name'] = ''
-				if 'email' not in actor:
-					actor['email'] = ''
-				if 'node_id' not in actor:
-					continue
-				usermap[login] = User(
-					login,
-					actor['name'],
-					actor['email'],
-					actor['avatar_url'],
-					event['json'],
-					actor['node_id']
-				)
-			progress.update(event['fileprogress'] - progress.n)
+			if known(login) or login in details or 'node_id' not in actor:
+				continue
+			if 'name' in actor and 'email' in actor:
+				details[login] = (actor, event['fileref'])
+			elif login not in summaries:
+				summaries[login] = (actor, event['fileref'])
+	for login in details:
+		summaries.pop(login, None)
+	rawjson = events.rawjson
+	for login, (actor, fileref) in tqdm({**details, **summaries}.items(), desc='new users', unit='user'):
+		usermap[login] = User(
+			login,
+			actor.get('name', ''),
+			actor.get('email', ''),
+			actor['avatar_url'],
+			rawjson(fileref),
+			actor['node_id']
+		)
+
+# event handlers, by gharchive event type.  each is passed the bug the event is on, if any.
+# a true return means the event needed nothing further.
+
+issuestates = {'opened':'open','closed':'closed'}
+issuechanges = {'opened':'open','closed':'close'}
+
+def importissuesevent(event, events, bug):
+	# open and close are different from create
+	action = event['payload']['action']
+	change = issuechanges.get(action)
+	if change is not None:
+		created_at_timestamp = int(event['created_at_datetime'].timestamp())
+		if created_at_timestamp < bug.modtime or bug.status == issuestates[action]:
+			return True
+		usermap.adopt(event['actor']['login'])
+		bugmap.setstatus(bug, created_at_timestamp, change, events.rawjson(event['fileref']))
+
+def importissuecommentevent(event, events, bug):
+	# add comment to issue
+	#if event[
+	pass
+
+def importotherevent(event, events, bug):
+	pass
+
+importhandlers = {
+	'IssuesEvent': importissuesevent,
+	'IssueCommentEvent': importissuecommentevent,
+}
 
 def importevent(event, events):
-	created_at_timestamp = int(event['created_at_datetime'].timestamp())
 	payload = event['payload']
+	bug = None
 	if 'issue' in payload:
 		ghbug = payload['issue']
 		number = ghbug['number']
-		ghbug_new = number not in bugmap
-		if ghbug_new:
+		bug = bugmap.get(number)
+		if bug is None:
 			# this creates the bug if not created
 			raise Exception("we're passing open/closed state but it's not being used yet.  probably only want to pass it if it's not being set the same; might make sense to set it afterwards instead of passing it, doesn't really matter.")
 			bug = Bug(
@@ -525,162 +789,90 @@ def importevent(event, events):
 					bugmap.setstatus(bug, int(parsedate(ghbug['closed_at']).timestamp()), 'closed', ghevent['json'])
 			else:
 				raise Exception("not sure what state " + ghbug['state'] + " is")
-		else:
-			bug = bugmap[number]
-	if event['type'] == 'IssuesEvent':
-		# open and close are different from create
-		if payload['action'] == 'opened' or payload['action'] == 'closed':
-			state = {'opened':'open','closed':'closed'}[payload['action']]
-			change = {'opened':'open','closed':'close'}[payload['action']]
-			if created_at_timestamp < bug.modtime or bug.status == state:
-				return
-			usermap.adopt(event['actor']['login'])
-			bugmap.setstatus(bug, created_at_timestamp, change, event['json'])
-	elif event['type'] == 'IssueCommentEvent':
-		# add comment to issue
-		#if event[
-		pass
+	if importhandlers.get(event['type'], importotherevent)(event, events, bug):
+		return
 	raise Exception(event)
 		
 
-importusers(events)
-try:
-	for bugnumber, bugevents in tqdm(bugmap.bugcache.items(), desc='importing issues+prs', unit='bug'):
-		bugevents = [events.from_fileref(bugevent) for bugevent in bugevents]
-		print(bugevents[0])
-		if bugevents[0]['type'] != 'IssuesEvent' or bugevents[0]['payload']['action'] != 'opened':
-			for event in bugevents:
-				print(bugnumber, event)
-				event = events.from_fileref(event)
-				del event['created_at_datetime']
-				print(json.dumps(event,indent=2))
-				raise Exception("first event is not opened?  are they in right order?")
-		# accumulate all the bug details, so it can be made in one go.
+def main():
+	# nothing is read, and git-bug isn't run, until the arguments are known to be good.
+	# this also keeps the process pool's workers from redoing it if they import this file
+	global events, gitbug, usermap, bugmap
+	parser = argparse.ArgumentParser()
+	parser.add_argument("dir", help="folder containing only gharchive newline-delimited .json files")
+	args = parser.parse_args()
+
+	print('this uses xloem\'s fork of git-bug that lets manual details be supplied')
+	print('https://github.com/xloem/git-bug/tree/manual-details\n')
+
+	events = EventsDir(args.dir)
+	gitbug = GitBugClient()
+	usermap = Users(gitbug)
+	bugmap = Bugs(events, gitbug)
+
+	importusers(events)
+	def readbugs():
+		for bugnumber, filerefs in bugmap.bugcache.items():
+			yield bugnumber, [events.from_fileref(fileref) for fileref in filerefs]
+	try:
+		# the next bugs' events are read back and parsed while git-bug writes this one.
+		# the writes themselves stay serial: they share one repository and 'user adopt' is repository-wide
+		for bugnumber, bugevents in tqdm(prefetch(readbugs(), 16), total=len(bugmap.bugcache), desc='importing issues+prs', unit='bug'):
+			print(bugevents[0])
+			if bugevents[0]['type'] != 'IssuesEvent' or bugevents[0]['payload']['action'] != 'opened':
+				for event in bugevents:
+					print(bugnumber, event)
+					# already read back from its fileref above
+					del event['created_at_datetime']
+					print(json.dumps(event,indent=2))
+					raise Exception("first event is not opened?  are they in right order?")
+			# accumulate all the bug details, so it can be made in one go.
 		
-		ghbug = bugevents[0]['payload']['issue']
-		bug = Bug(
-			ghbug['title'],
-			ghbug['body'],
-			usermap[ghbug['user']['login']].hash,
-			int(parsedate(ghbug['created_at']).timestamp()),
-			'open',
-			ghbug['url'],
-			ghbug['json'],
-			ghbug['node_id']
-		)
-		bugmapevents = []
-		#if ghbug['state'] == 'open':
-		#	pass
-		#elif ghbug['state'] == 'closed':
-		#	if bugevents[0]['payload']['action'] == 'closed':
-		#		pass
-		#	elif bugevents[0]['payload']['action'] == 'opened':
-		#		# ADD USER
-		#		bugmapevents.append((parsedate(ghbug['closed_at']).timestamp(), 'close', ghbug['json']))
-
-		#	else:
-		#		raise Exception('not sure what state ' + bugevents[0]['payload']['action'] + ' is')
-		#else:
-		#	raise Exception('not sure what state ' + ghbug['state'] + ' is')
-		for bugevent in bugevents:
-			raise Exception(bugevent)
-			user = bugevent['actor']['login']
-			
-			# we could run into an issue, unknown.  look at bugs afterwards to make sure are correct.
-			if bugevent['payload']['action'] in ('closed','opened'):
-				# status event
-				#bugmapevents.append((parsedate(ghbug[
-				pass
-			del bugevent['created_at_datetime']
-			print(json.dumps(bugevent,indent=2))
-		break
-	#with tqdm(total=events.filecount,desc='json files, events',unit='file') as progress:
-	#	for event in events:
-	#		importevent(event, events)
-	#		progress.update(event['fileprogress'] - progress.n)
-except Exception as e:
-	event=e.args[0]
-	del event['json']
-	del event['created_at_datetime']
-	print(json.dumps(event,indent=2))
-sys.exit(0)
-
-# args.dir
-numbers = [int(filename.split('.')[0]) for filename in os.listdir(args.dir)]
-numbers.sort()
-
-for event in events:
-	if 'id' in event:
-		del event['id']
-	if 'url' in event:
-		del event['url']
-	del event['public']
-
-	actor = event['actor']
-	payload = event['payload']
+			ghbug = bugevents[0]['payload']['issue']
+			bug = Bug(
+				ghbug['title'],
+				ghbug['body'],
+				usermap[ghbug['user']['login']].hash,
+				int(parsedate(ghbug['created_at']).timestamp()),
+				'open',
+				ghbug['url'],
+				ghbug['json'],
+				ghbug['node_id']
+			)
+			bugmapevents = []
+			#if ghbug['state'] == 'open':
+			#	pass
+			#elif ghbug['state'] == 'closed':
+			#	if bugevents[0]['payload']['action'] == 'closed':
+			#		pass
+			#	elif bugevents[0]['payload']['action'] == 'opened':
+			#		# ADD USER
+			#		bugmapevents.append((parsedate(ghbug['closed_at']).timestamp(), 'close', ghbug['json']))
 
-	login = actor['login']
-	if login in usermap:
-		user = usermap[login]
-	else:
-		user = User(
-			'@' + actor['login'] + ' ' + actor['name'],
-			actor['email'],
-			'https://gravatar.com/avatar/' + actor['gravatar_id'],
-			actor
-		)
-		usermap[login] = user
-	processed = False
-	if event['type'] == 'IssuesEvent':
-		if 'number' in payload:
-			num = payload['number']
-		else:
-			num = payload['issue']['number']
+			#	else:
+			#		raise Exception('not sure what state ' + bugevents[0]['payload']['action'] + ' is')
+			#else:
+			#	raise Exception('not sure what state ' + ghbug['state'] + ' is')
+			for bugevent in bugevents:
+				raise Exception(bugevent)
+				user = bugevent['actor']['login']
 			
-		if num in bugmap:
-			issue = bugmap[num]
-		else:
-			issue = None
-			for event in events:
-				subpayload = event['payload']
-				if isinstance(subpayload['issue'], dict):
-					issue = subpayload['issue']
-					issue = Bug(
-						issue['title'],
-						issue['body'],
-						issue['user']['login'],
-						parsedate(issue['created_at'])
-					)
-					break
-			if issue is None:
-				issue = Bug(
-					'lost issue #' + str(num),
-					'The body of this issue was not recovered\n' +
-					'```' +
-					'\n'.join((json.dumps(event) for event in events))
-					+ '\n```',
-					None,
-					parsedate(event['created_at'])
-				)
-			run('git bug user adopt', usermap[issue.user].hash)
-			issue.hash = run(
-				'git bug add',
-				'--title', issue.title,
-				'--message', issue.body,
-				'--time', int(issue.time.timestamp())
-			)[-1].split(' ')[0]
-			issuemap[num] = issue
-	run('git bug user adopt', user.hash)
-	if event['type'] == 'IssuesEvent':
-		if payload['action'] == 'closed':
-			run(
-				'git bug status close',
-				issue.hash,
-				'-u', int(parsedate(event['created_at']).timestamp())
-			)
-			processed = True
-					
-		
-	if not processed:
-		for key in event:
-			print(key, event[key])
+				# we could run into an issue, unknown.  look at bugs afterwards to make sure are correct.
+				if bugevent['payload']['action'] in ('closed','opened'):
+					# status event
+					#bugmapevents.append((parsedate(ghbug[
+					pass
+				del bugevent['created_at_datetime']
+				print(json.dumps(bugevent,indent=2))
+			break
+		#with tqdm(total=events.filecount,desc='json files, events',unit='file') as progress:
+		#	for event in events:
+		#		importevent(event, events)
+		#		progress.update(event['fileprogress'] - progress.n)
+	except Exception as e:
+		event=e.args[0]
+		del event['created_at_datetime']
+		print(json.dumps(event,indent=2))
+
+if __name__ == '__main__':
+	main()
@@ -1,30 +1,39 @@
 # coding: utf-8
 from __future__ import unicode_literals
 
+import concurrent.futures
 import json
 import datetime
+import hashlib
 import re
 import subprocess
 import asyncio
 import websockets
 import _thread
 import queue
+import weakref
 
 from .common import InfoExtractor, SearchInfoExtractor
 from ..compat import (
+    compat_etree_fromstring,
     compat_parse_qs,
+    compat_urllib_parse_unquote_to_bytes,
     compat_urlparse,
+    compat_xml_parse_error,
 )
 from ..utils import (
+    clean_html,
     determine_ext,
     dict_get,
     ExtractorError,
     int_or_none,
     float_or_none,
+    orderedSet,
     parse_duration,
     parse_iso8601,
     remove_start,
     try_get,
+    unescapeHTML,
     unified_timestamp,
     urlencode_postdata,
     compat_urllib_parse_unquote_plus,
@@ -33,8 +42,65 @@ from ..utils import (
     xpath_element,
 )
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
-class NiconicoIE(InfoExtractor):
+
+def _json_dumps_bytes(obj):
+    # orjson serializes straight to UTF-8 bytes, several times faster
+    if orjson:
+        return orjson.dumps(obj)
+    return json.dumps(obj).encode()
+
+
+_json_loads = orjson.loads if orjson else json.loads
+
+
+class NiconicoBaseIE(InfoExtractor):
+    _NETRC_MACHINE = 'niconico'
+    # login results by downloader, then by account
+    _LOGINS = weakref.WeakKeyDictionary()
+
+    def _real_initialize(self):
+        self._login()
+
+    def _login(self):
+        username, password = self._get_login_info()
+        # No authentication to be performed
+        if not username:
+            return True
+
+        # the cookie jar is shared by every extractor of a downloader, so log in once per account
+        logins = self._LOGINS.setdefault(self._downloader, {})
+        login_key = (username, hashlib.sha256(password.encode('utf-8')).hexdigest())
+        if login_key in logins:
+            return logins[login_key]
+
+        # Log in
+        login_ok = True
+        login_form_strs = {
+            'mail_tel': username,
+            'password': password,
+        }
+        urlh = self._request_webpage(
+            'https://account.nicovideo.jp/api/v1/login', None,
+            note='Logging in', errnote='Unable to log in',
+            data=urlencode_postdata(login_form_strs))
+        if urlh is False:
+            login_ok = False
+        else:
+            parts = compat_urlparse.urlparse(urlh.geturl())
+            if compat_parse_qs(parts.query).get('message', [None])[0] == 'cant_login':
+                login_ok = False
+        if not login_ok:
+            self._downloader.report_warning('unable to log in: bad username or password')
+        logins[login_key] = login_ok
+        return login_ok
+
+
+class NiconicoIE(NiconicoBaseIE):
     IE_NAME = 'niconico'
     IE_DESC = 'ニコニコ動画'
 
@@ -166,36 +232,49 @@ class NiconicoIE(InfoExtractor):
     }]
 
     _VALID_URL = r'https?://(?:www\.|secure\.|sp\.)?nicovideo\.jp/watch/(?P<id>(?:[a-z]{2})?[0-9]+)'
-    _NETRC_MACHINE = 'niconico'
-
-    def _real_initialize(self):
-        self._login()
-
-    def _login(self):
-        username, password = self._get_login_info()
-        # No authentication to be performed
-        if not username:
-            return True
-
-        # Log in
-        login_ok = True
-        login_form_strs = {
-            'mail_tel': username,
-            'password': password,
-        }
-        urlh = self._request_webpage(
-            'https://account.nicovideo.jp/api/v1/login', None,
-            note='Logging in', errnote='Unable to log in',
-            data=urlencode_postdata(login_form_strs))
-        if urlh is False:
-            login_ok = False
-        else:
-            parts = compat_urlparse.urlparse(urlh.geturl())
-            if compat_parse_qs(parts.query).get('message', [None])[0] == 'cant_login':
-                login_ok = False
-        if not login_ok:
-            self._downloader.report_warning('unable to log in: bad username or password')
-        return login_ok
+    # the most comment requests to have in flight at once
+    _MAX_COMMENT_REQUESTS = 8
+    # searched on every extraction, so compiled once
+    _WATCH_API_DATA_RE = re.compile(r'<div[^>]+id="watchAPIDataContainer"[^>]+>([^<]+)</div>')
+    _API_DATA_RE = re.compile(r'data-api-data="([^"]+)"')
+    _TITLE_RE = re.compile(r'<span[^>]+class="videoHeaderTitle"[^>]*>([^<]+)</span>')
+    # every <meta> tag of the page is read in one pass, by the same attributes _html_search_meta looks at
+    _META_TAG_RE = re.compile(r'<meta\s(?:[^>"\']|"[^"]*"|\'[^\']*\')*>', re.IGNORECASE)
+    _META_ATTR_RE = re.compile(
+        r'(itemprop|name|property|id|http-equiv|content)=(["\']?)(.*?)\2(?=\s|/?>|$)', re.IGNORECASE | re.DOTALL)
+    _VIEW_COUNT_RE = re.compile(r'>Views: <strong[^>]*>([^<]+)</strong>')
+    _COMMENT_COUNT_RE = re.compile(r'>Comments: <strong[^>]*>([^<]+)</strong>')
+    _THREAD_IDS_RE = re.compile(r'threadIds&quot;:\[{&quot;id&quot;:([0-9]*)')
+    # the comment request for a thread, serialized once: the thread itself, then each language's
+    # leaves in their own ping fork. The leaves content format is
+    # "<bottom of minute range>-<top of minute range>:<comments per minute>,<total last comments";
+    # unfortunately NND limits (deletes?) comment returns this way, so you're only able to grab the last 1000 per language
+    _COMMENT_REQUEST_HEAD = (
+        b'[{"ping":{"content":"rs:0"}},{"ping":{"content":"ps:0"}},'
+        b'{"thread":{"thread":%b,"version":"20090904","fork":0,"language":0,"user_id":"","with_global":0,"scores":1,"nicoru":3}},'
+        b'{"ping":{"content":"pf:0"}}')
+    _COMMENT_REQUEST_FORK = (
+        b'{"ping":{"content":"ps:%d"}},'
+        b'{"thread_leaves":{"thread":%b,"language":%d,"user_id":"","content":"0-999999:999999,999999","scores":1,"nicoru":3}},'
+        b'{"ping":{"content":"pf:%d"}}')
+    _COMMENT_REQUEST_TAIL = b'{"ping":{"content":"rf:0"}}]'
+    # the view and comment counts in the page are written with thousands separators
+    _STRIP_COMMAS = str.maketrans('', '', ',')
+
+    def _extract_meta(self, webpage):
+        # maps each meta tag's name, property, etc., lowercased as _html_search_meta matches them
+        # case-insensitively, to its raw content; the first tag wins, as in a search.
+        # Callers clean the values the way the _og_search_* or _html_search_meta lookup would
+        meta = {}
+        for tag in self._META_TAG_RE.findall(webpage):
+            attrs = dict((attr.lower(), value) for attr, _, value in self._META_ATTR_RE.findall(tag))
+            content = attrs.pop('content', None)
+            if content is None:
+                continue
+            for key in attrs.values():
+                if key:
+                    meta.setdefault(key.lower(), content)
+        return meta
 
     def _extract_format_for_quality(self, api_data, video_id, audio_quality, video_quality):
         def yesno(boolean):
@@ -211,7 +290,7 @@ class NiconicoIE(InfoExtractor):
             query={'_format': 'json'},
             headers={'Content-Type': 'application/json'},
             note='Downloading JSON metadata for %s' % format_id,
-            data=json.dumps({
+            data=_json_dumps_bytes({
                 'session': {
                     'client_info': {
                         'player_id': session_api_data['player_id'],
@@ -261,11 +340,11 @@ class NiconicoIE(InfoExtractor):
                     },
                     'timing_constraint': 'unlimited'
                 }
-            }).encode())
+            }))
 
         # get heartbeat info
         heartbeat_url = session_api_endpoint['url'] + '/' + session_response['data']['session']['id'] + '?_format=json&_method=PUT'
-        heartbeat_data = json.dumps(session_response['data']).encode()
+        heartbeat_data = _json_dumps_bytes(session_response['data'])
         # interval, convert milliseconds to seconds, then halve to make a buffer.
         heartbeat_interval = session_api_data['heartbeat_lifetime'] / 8000
 
@@ -285,6 +364,16 @@ class NiconicoIE(InfoExtractor):
             'heartbeat_interval': heartbeat_interval,
         }
 
+    def _extract_watch_api_data(self, webpage, video_id):
+        watch_api_data_string = self._html_search_regex(
+            self._WATCH_API_DATA_RE, webpage, 'watch api data', default=None)
+        if watch_api_data_string is None:
+            return None
+        try:
+            return _json_loads(watch_api_data_string)
+        except ValueError as ve:
+            raise ExtractorError('%s: Failed to parse JSON ' % video_id, cause=ve)
+
     def _real_extract(self, url):
         video_id = self._match_id(url)
         
@@ -292,11 +381,16 @@ class NiconicoIE(InfoExtractor):
             'http://ext.nicovideo.jp/api/getthumbinfo/' + video_id,
             video_id, note='Downloading video info page')
 
+        # the first text of each tag, as './/tag' would find it, in one walk of the tree
+        video_info = {}
+        for element in video_info_xml.iter():
+            video_info.setdefault(element.tag, element.text)
+
         def get_video_info(items):
             if not isinstance(items, list):
                 items = [items]
             for item in items:
-                ret = xpath_text(video_info_xml, './/' + item)
+                ret = video_info.get(item)
                 if ret:
                     return ret
 
@@ -304,6 +398,8 @@ class NiconicoIE(InfoExtractor):
         extension = get_video_info('movie_type')
 
         formats = []
+        # the flash player page's watch API data, if it was fetched
+        watch_api = None
 
         def getWebpage(video_id, note=False):
             webpage, handle = self._download_webpage_handle(
@@ -323,39 +419,44 @@ class NiconicoIE(InfoExtractor):
 
             flv_info = compat_urlparse.parse_qs(flv_info_api)
 
-            webpage = getWebpage(video_id, note='Downloading flash player webpage')
-
-            watch_api_data_string = self._html_search_regex(
-                r'<div[^>]+id="watchAPIDataContainer"[^>]+>([^<]+)</div>',
-                webpage, 'watch api data', default=None)
-            
-            if watch_api_data_string == None:
-                    self._downloader.report_warning('Could not get flv info, as it requires logging in')
+            if 'closed' in flv_info:
+                # getflv already says this needs logging in, and the flash player
+                # page is served with the same cookies, so it isn't fetched
+                self._downloader.report_warning('Could not get flv info, as it requires logging in')
 
             else:
+                webpage = getWebpage(video_id, note='Downloading flash player webpage')
 
-                watch_api = json.loads(watch_api_data_string)
-                player_flv_info = compat_parse_qs(compat_urllib_parse_unquote_plus(compat_urllib_parse_unquote_plus(watch_api['flashvars']['flvInfo'])))
-
-                if 'url' not in player_flv_info:
-                    if 'deleted' in flv_info:
-                        raise ExtractorError('The video has been deleted.',
-                                            expected=True)
-                    elif 'closed' in flv_info:
-                        self._downloader.report_warning('Could not get flv info, as it requires logging in')
-                    elif 'error' in flv_info:
-                        raise ExtractorError('%s reports error: %s' % (
-                            self.IE_NAME, flv_info['error'][0]), expected=True)
-                    else:
-                        raise ExtractorError('Unable to find flv URL')
+                watch_api = self._extract_watch_api_data(webpage, video_id)
+
+                if watch_api is None:
+                    self._downloader.report_warning('Could not get flv info, as it requires logging in')
 
                 else:
-                    
+
+                    # flvInfo is quoted twice over; the second pass only changes anything
+                    # if the first left a '%' or '+' in it
+                    flv_info_string = compat_urllib_parse_unquote_plus(watch_api['flashvars']['flvInfo'])
+                    if '%' in flv_info_string or '+' in flv_info_string:
+                        flv_info_string = compat_urllib_parse_unquote_plus(flv_info_string)
+                    player_flv_info = compat_parse_qs(flv_info_string)
+
+                    if 'url' not in player_flv_info:
+                        if 'deleted' in flv_info:
+                            raise ExtractorError('The video has been deleted.',
+                                                 expected=True)
+                        elif 'error' in flv_info:
+                            raise ExtractorError('%s reports error: %s' % (
+                                self.IE_NAME, flv_info['error'][0]), expected=True)
+                        else:
+                            raise ExtractorError('Unable to find flv URL')
+
+                    # the same cookies go with every flash URL
+                    flash_cookie_header = self._get_cookies('http://nicovideo.jp').output(header='', sep=';')
+
                     for video_url in player_flv_info['url']:
                         is_source = not video_url.endswith('low')
 
-                        flash_cookies = self._get_cookies('http://nicovideo.jp')
-
                         formats.append({
                             'url': video_url,
                             'ext': extension,
@@ -363,10 +464,10 @@ class NiconicoIE(InfoExtractor):
                             'format_note': 'Source flash video' if is_source else 'Low quality flash video',
                             'acodec': 'mp3',
                             'container': extension,
-                            'http_headers': {'Cookie': flash_cookies.output(header='', sep=';')},
+                            'http_headers': {'Cookie': flash_cookie_header},
                             'quality': 10 if is_source else -2
                         })
-        
+
         # Either source video is a mp4 (DMC or smile), or we're grabbing other qualities alongside the flash video
         self._set_cookie('nicovideo.jp', 'watch_flash', '0')
 
@@ -376,7 +477,7 @@ class NiconicoIE(InfoExtractor):
         webpage = getWebpage(video_id, note='Downloading HTML5 player webpage')
 
         api_data = self._parse_json(self._html_search_regex(
-            'data-api-data="([^"]+)"', webpage,
+            self._API_DATA_RE, webpage,
             'API data', default='{}'), video_id)
 
         dmc_info = api_data['video'].get('dmcInfo')
@@ -407,24 +508,25 @@ class NiconicoIE(InfoExtractor):
         self._sort_formats(formats)
 
         # Start extracting information
+        meta = self._extract_meta(webpage)
+
         title = get_video_info('title')
         if not title:
-            title = self._og_search_title(webpage, default=None)
+            title = unescapeHTML(meta.get('og:title') or meta.get('og-title'))
         if not title:
             title = self._html_search_regex(
-                r'<span[^>]+class="videoHeaderTitle"[^>]*>([^<]+)</span>',
-                webpage, 'video title')
+                self._TITLE_RE, webpage, 'video title')
 
-        watch_api_data_string = self._html_search_regex(
-            r'<div[^>]+id="watchAPIDataContainer"[^>]+>([^<]+)</div>',
-            webpage, 'watch api data', default=None)
-        watch_api_data = self._parse_json(watch_api_data_string, video_id) if watch_api_data_string else {}
+        # the flash player page carries the same data, so the HTML5 page is only searched without it
+        watch_api_data = watch_api
+        if watch_api_data is None:
+            watch_api_data = self._extract_watch_api_data(webpage, video_id) or {}
         video_detail = watch_api_data.get('videoDetail', {})
 
         thumbnail = (
-            self._html_search_regex(r'<meta property="og:image" content="([^"]+)">', webpage, 'thumbnail data', default=None)
+            unescapeHTML(meta.get('og:image'))
             or get_video_info(['largeThumbnailURL', 'thumbnail_url', 'thumbnailURL'])
-            or self._html_search_meta('image', webpage, 'thumbnail', default=None)
+            or clean_html(meta.get('image'))
             or video_detail.get('thumbnail'))
 
         description = get_video_info('description')
@@ -432,7 +534,7 @@ class NiconicoIE(InfoExtractor):
         timestamp = (parse_iso8601(get_video_info('first_retrieve'))
                      or unified_timestamp(get_video_info('postedDateTime')))
         if not timestamp:
-            match = self._html_search_meta('datePublished', webpage, 'date published', default=None)
+            match = clean_html(meta.get('datepublished'))
             if match:
                 timestamp = parse_iso8601(match.replace('+', ':00+'))
         if not timestamp and video_detail.get('postedAt'):
@@ -443,10 +545,9 @@ class NiconicoIE(InfoExtractor):
         view_count = int_or_none(get_video_info(['view_counter', 'viewCount']))
         if not view_count:
             match = self._html_search_regex(
-                r'>Views: <strong[^>]*>([^<]+)</strong>',
-                webpage, 'view count', default=None)
+                self._VIEW_COUNT_RE, webpage, 'view count', default=None)
             if match:
-                view_count = int_or_none(match.replace(',', ''))
+                view_count = int_or_none(match.translate(self._STRIP_COMMAS))
         view_count = view_count or video_detail.get('viewCount')
 
         comment_count = (int_or_none(get_video_info('comment_num'))
@@ -454,15 +555,13 @@ class NiconicoIE(InfoExtractor):
                          or try_get(api_data, lambda x: x['thread']['commentCount']))
         if not comment_count:
             match = self._html_search_regex(
-                r'>Comments: <strong[^>]*>([^<]+)</strong>',
-                webpage, 'comment count', default=None)
+                self._COMMENT_COUNT_RE, webpage, 'comment count', default=None)
             if match:
-                comment_count = int_or_none(match.replace(',', ''))
+                comment_count = int_or_none(match.translate(self._STRIP_COMMAS))
 
         duration = (parse_duration(
             get_video_info('length')
-            or self._html_search_meta(
-                'video:duration', webpage, 'video duration', default=None))
+            or clean_html(meta.get('video:duration')))
             or video_detail.get('length')
             or get_video_info('duration'))
 
@@ -485,28 +584,27 @@ class NiconicoIE(InfoExtractor):
 
         if get_comments or write_subs:
             # first need to get the thread ID from the html
-            thread_ids = list(set(re.findall(r'threadIds&quot;:\[{&quot;id&quot;:([0-9]*)', webpage)))
+            # deduplicated in page order, so requests and results are the same every run
+            thread_ids = orderedSet(self._THREAD_IDS_RE.findall(webpage))
             root_thread_id = 0 # thread_ids[0]
 
             # make API calls
-            raw_comments = {
-                'en': self._extract_all_comments(video_id, thread_ids, 1),
-                'jp': self._extract_all_comments(video_id, thread_ids, 0),
-                'cn': self._extract_all_comments(video_id, thread_ids, 2),
-            }
+            raw_comments = dict(zip(
+                ('en', 'jp', 'cn'),
+                self._extract_all_comments(video_id, thread_ids, (1, 0, 2))))
             
             subtitles = {
                 'eng': [{
                     'ext': 'ass',
-                    'data': NiconicoIE.CreateDanmaku(json.dumps(raw_comments['en']))
+                    'data': NiconicoIE.CreateDanmaku(_json_dumps_bytes(raw_comments['en']).decode('utf-8'))
                 }],
                 'jpn': [{
                     'ext': 'ass',
-                    'data': NiconicoIE.CreateDanmaku(json.dumps(raw_comments['jp']))
+                    'data': NiconicoIE.CreateDanmaku(_json_dumps_bytes(raw_comments['jp']).decode('utf-8'))
                 }],
                 'zh': [{
                     'ext': 'ass',
-                    'data': NiconicoIE.CreateDanmaku(json.dumps(raw_comments['cn']))
+                    'data': NiconicoIE.CreateDanmaku(_json_dumps_bytes(raw_comments['cn']).decode('utf-8'))
                 }]
             }
 
@@ -516,8 +614,7 @@ class NiconicoIE(InfoExtractor):
 
 
 
-        tags_nodes = video_info_xml.findall('.//tags/tag')
-        tags = list(map(lambda x: x.text, tags_nodes))
+        tags = [tag.text for tag in video_info_xml.iterfind('.//tags/tag')]
         
         genre = get_video_info('genre')
 
@@ -548,46 +645,38 @@ class NiconicoIE(InfoExtractor):
 
     @staticmethod
     def CreateDanmaku(raw_comments_list, commentType='NiconicoJson', x=640, y=360):
+        # ReadComments closes the input once it has been read, freeing it early
         temp_io = io.StringIO()
-        comment_io = io.StringIO(raw_comments_list)
-        Danmaku2ASS([comment_io], commentType, temp_io, x, y)
+        Danmaku2ASS([io.StringIO(raw_comments_list)], commentType, temp_io, x, y)
         danmaku_content = temp_io.getvalue()
-
         temp_io.close()
-        comment_io.close()
 
         return danmaku_content
 
 
     def _process_raw_comments(self, raw_comments_list, root_thread_id, language):
-        comments = []
-
-        for raw_comment in raw_comments_list:
-            if 'chat' not in raw_comment:
-                continue
-
-            raw_comment = raw_comment['chat']
-
-            comments.append({
-                'parent': 'root' if raw_comment.get('parent') == root_thread_id else raw_comment.get('parent'),
-                'id': raw_comment.get('no'),
-                'author_id': raw_comment.get('user_id'),
-                'text': raw_comment.get('content'),
-                'timestamp': raw_comment.get('date'),
-                'language' : language
-            })
-        
-        return comments
-
-    def _extract_all_comments(self, video_id, thread_ids, language_id):
-
-        i = 0
-        raw_json = []
-
-        for thread_id in thread_ids:
-
-            i += 1
-            raw_json += self._download_json(
+        chats = (raw_comment['chat'] for raw_comment in raw_comments_list if 'chat' in raw_comment)
+        return [{
+            'parent': 'root' if chat.get('parent') == root_thread_id else chat.get('parent'),
+            'id': chat.get('no'),
+            'author_id': chat.get('user_id'),
+            'text': chat.get('content'),
+            'timestamp': chat.get('date'),
+            'language': language
+        } for chat in chats]
+
+    def _extract_all_comments(self, video_id, thread_ids, language_ids):
+        # one request per thread asks for the leaves of every language, each in its own
+        # ping fork; the threads are requested concurrently. Returns the comments for each
+        # of language_ids, in order
+        def download_thread(job):
+            i, thread_id = job
+            thread_id_json = _json_dumps_bytes(thread_id)
+            request = [self._COMMENT_REQUEST_HEAD % thread_id_json]
+            for fork, language_id in enumerate(language_ids, 1):
+                request.append(self._COMMENT_REQUEST_FORK % (fork, thread_id_json, language_id, fork))
+            request.append(self._COMMENT_REQUEST_TAIL)
+            return self._download_json(
                 'https://nmsg.nicovideo.jp/api.json/',
                 video_id,
                 headers={
@@ -600,39 +689,29 @@ class NiconicoIE(InfoExtractor):
                     'Origin': 'https://www.nicovideo.jp',
                     'Connection': 'keep-alive'
                 },
-                data=json.dumps([
-                        { "ping": {"content": "rs:0" } },
-                        { "ping": {"content": "ps:0" } },
-                        { "thread": {
-                            "thread": thread_id,
-                            "version": "20090904",
-                            "fork": 0,
-                            "language": 0,
-                            "user_id": "",
-                            "with_global": 0,
-                            "scores": 1,
-                            "nicoru": 3
-                        }},
-                        { "ping": {"content": "pf:0" } },
-                        { "ping": {"content": "ps:1" } },
-                        { "thread_leaves": {
-                            "thread": thread_id,
-                            "language": language_id,
-                            "user_id": "",
-                            "content": "0-999999:999999,999999", # format is "<bottom of minute range>-<top of minute range>:<comments per minute>,<total last comments"
-                                                                 # unfortunately NND limits (deletes?) comment returns this way, so you're only able to grab the last 1000 per language
-                            "scores": 1,
-                            "nicoru": 3
-                        }},
-                        { "ping": {"content": "pf:1" } },
-                        { "ping": {"content": "rf:0" } }
-                    ]).encode(),
-                note='Downloading comments from thread %s/%s (%s)' % (i, len(thread_ids), 'en' if language_id == 1 else
-                                                                                          'jp' if language_id == 0 else
-                                                                                          'cn' if language_id == 2 else 
-                                                                                          'unknown')
+                data=b','.join(request),
+                note='Downloading comments from thread %s/%s' % (i, len(thread_ids))
             )
 
+        raw_json = [[] for language_id in language_ids]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self._MAX_COMMENT_REQUESTS) as executor:
+            # map keeps the results in thread order
+            for thread_json in executor.map(download_thread, enumerate(thread_ids, 1)):
+                # what falls in a language's fork is that language's alone; the rest,
+                # such as the thread's own response, goes to every language
+                language_json = None
+                for item in thread_json:
+                    ping = item.get('ping', {}).get('content', '') if isinstance(item, dict) else ''
+                    if ping.startswith('ps:') and ping != 'ps:0':
+                        language_json = raw_json[int(ping[3:]) - 1]
+                    if language_json is not None:
+                        language_json.append(item)
+                    else:
+                        for every_json in raw_json:
+                            every_json.append(item)
+                    if ping.startswith('pf:'):
+                        language_json = None
+
         return raw_json
 
 
@@ -654,7 +733,7 @@ class NiconicoPlaylistIE(InfoExtractor):
 
         entries_json = self._search_regex(r'Mylist\.preload\(\d+, (\[.*\])\);',
                                           webpage, 'entries')
-        entries_raw = json.loads(entries_json)
+        entries_raw = _json_loads(entries_json)
         entries = [{
             '_type': 'url',
             'ie_key': NiconicoIE.ie_key(),
@@ -682,6 +761,12 @@ class NicovideoIE(SearchInfoExtractor):
     _START_DATE = datetime.date(2007, 1, 1)
     _MAX_NUMBER_OF_PAGES = 50
     _RESULTS_PER_PAGE = 32
+    # the most search pages to request at once
+    _MAX_CONCURRENT_PAGES = 4
+    # searched on every page of results
+    _VIDEO_ID_RE = re.compile(r'(?<=data-video-id=)["\']?(?P<videoid>.*?)(?=["\'])')
+    # present on every page of results but the last
+    _NEXT_PAGE_RE = re.compile(r'<link[^>]+rel=["\']next["\']')
 
     def _get_n_results(self, query, n):
         """Get a specified number of results for a query"""
@@ -689,7 +774,7 @@ class NicovideoIE(SearchInfoExtractor):
         currDate = datetime.datetime.now().date()
 
         search_url = "http://www.nicovideo.jp/search/%s" % query
-        r = self._get_entries_for_span(search_url, query, self._START_DATE, currDate)
+        r = self._get_entries_for_span(search_url, query, self._START_DATE, currDate, max_entries=n)
 
         # did we gather more entries than were asked for? If so, only add as many as are needed to reach the desired number.
         m = n - len(entries)
@@ -727,81 +812,85 @@ class NicovideoIE(SearchInfoExtractor):
             'entries': entries
         }
 
-    def _get_entries_for_span(self, url, query, startDate, endDate):
-        # This page 50 request will be duplicated in the else case; not ideal
-        page_50_results = self._get_entries_for_date(url, query, startDate, endDate=endDate, pageNumber=50)
-        entries = []
-        # If the page 50 results return 32 videos, we need to break down the query interval to ensure we've captured all videos
-        if (len(page_50_results) == self._RESULTS_PER_PAGE and startDate != endDate):
-            midpoint = startDate + (endDate - startDate)/2
-            right = self._get_entries_for_span(url, query, startDate, midpoint)
-            left = self._get_entries_for_span(url, query, midpoint, endDate)
-            entries = left + right
-        else:
-            entries = self._get_entries_for_date(url, query, startDate, endDate=endDate)
+    def _get_entries_for_span(self, url, query, startDate, endDate, max_entries=None):
+        # If the last page of a span is full, it may hold more videos than the search will list,
+        # so it is halved until no span is. Each round of spans is probed concurrently, and
+        # then the spans' pages are walked concurrently, newest span first as results are ordered.
+        def is_full(span):
+            # This page 50 request will be duplicated when the span's pages are walked; not ideal
+            return len(self._get_entries_for_date(
+                url, query, span[0], endDate=span[1], pageNumber=self._MAX_NUMBER_OF_PAGES)) == self._RESULTS_PER_PAGE
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self._MAX_CONCURRENT_PAGES) as executor:
+            spans = [(startDate, endDate)]
+            unsettled = [span for span in spans if span[0] != span[1]]
+            while unsettled:
+                full = set(span for span, span_is_full in zip(unsettled, executor.map(is_full, unsettled)) if span_is_full)
+                unsettled = []
+                halved = []
+                for span in spans:
+                    if span not in full:
+                        halved.append(span)
+                        continue
+                    midpoint = span[0] + (span[1] - span[0]) // 2
+                    halves = [(midpoint + datetime.timedelta(days=1), span[1]), (span[0], midpoint)]
+                    halved += halves
+                    unsettled += [half for half in halves if half[0] != half[1]]
+                spans = halved
+
+            futures = [
+                executor.submit(self._get_entries_for_date, url, query, span[0], endDate=span[1])
+                for span in spans]
+            entries = []
+            for future in futures:
+                entries += future.result()
+                if max_entries is not None and len(entries) >= max_entries:
+                    # the older spans aren't needed
+                    for future in futures:
+                        future.cancel()
+                    break
 
         return entries
 
-
     def _get_entries_for_date(self, url, query, startDate, endDate=None, pageNumber=1):
         if endDate is None:
             endDate = startDate
 
         entries = []
+        # whether these pages have been seen to link to the next one
+        links_next = False
         while True:
             link = url + "?page=" + str(pageNumber) + "&start=" + str(startDate) + "&end=" + str(endDate) + "&sort=f&order=d"
             results = self._download_webpage(link, "None", query={"Search_key": query}, note='Extracting results from page %s for date %s to %s' % (pageNumber, startDate, endDate))
-            r = re.findall(r'(?<=data-video-id=)["\']?(?P<videoid>.*?)(?=["\'])', results)
+            r = self._VIDEO_ID_RE.findall(results)
 
             for item in r:
                 e = self.url_result("http://www.nicovideo.jp/watch/" + item, 'Niconico', item)
                 entries.append(e)
 
-            # each page holds a maximum of 32 entries. If we've seen 32 entries on the current page,
-            # it's possible there may be another, so we can check. It's a little awkward, but it works.
             if(len(r) < self._RESULTS_PER_PAGE or pageNumber == self._MAX_NUMBER_OF_PAGES):
                 break
+            if self._NEXT_PAGE_RE.search(results):
+                links_next = True
+            elif links_next:
+                # a full last page; no need to fetch an empty one after it
+                break
+            # otherwise each page holds a maximum of 32 entries. If we've seen 32 entries on the current page,
+            # it's possible there may be another, so we can check. It's a little awkward, but it works.
 
             pageNumber += 1
 
         return entries
 
 
-class NiconicoLiveIE(InfoExtractor):
+class NiconicoLiveIE(NiconicoBaseIE):
     _VALID_URL = r'https?://live2?.nicovideo\.jp/watch/(?P<id>lv\d+)'
-    
-    _NETRC_MACHINE = 'niconico'
 
     _TEST = {} # fuck tests
 
-    def _real_initialize(self):
-        self._login()
-
-    def _login(self):
-        username, password = self._get_login_info()
-        # No authentication to be performed
-        if not username:
-            return True
-
-        # Log in
-        login_ok = True
-        login_form_strs = {
-            'mail_tel': username,
-            'password': password,
-        }
-        urlh = self._request_webpage(
-            'https://account.nicovideo.jp/api/v1/login', None,
-            note='Logging in', errnote='Unable to log in',
-            data=urlencode_postdata(login_form_strs))
-        if urlh is False:
-            login_ok = False
-        else:
-            parts = compat_urlparse.urlparse(urlh.geturl())
-            if compat_parse_qs(parts.query).get('message', [None])[0] == 'cant_login':
-                login_ok = False
-        if not login_ok:
-            self._downloader.report_warning('unable to log in: bad username or password')
-        return login_ok
+    # searched on every extraction, so compiled once
+    _EMBEDDED_DATA_RE = re.compile(r'id\s*=\s*"embedded-data"[^>]*data-props\s*=\s*"([^"]+)"')
+    _PLAYER_STATUS_RE = re.compile(r'"value_by_gps"\s*:\s*"([^"]+)"')
 
     async def stream_heartbeat(self, websocket, heartbeat_interval):
         heartbeat_frame = json.dumps({'type': 'keepSeat'})
@@ -834,7 +923,7 @@ class NiconicoLiveIE(InfoExtractor):
             heartbeat = None
             try:
                 while True:
-                    frame = json.loads(await websocket.recv())
+                    frame = _json_loads(await websocket.recv())
                     frame_type = frame["type"]
 
                     if frame_type == "stream":
@@ -864,7 +953,7 @@ class NiconicoLiveIE(InfoExtractor):
         video_id = self._match_id(url)
         webpage = self._download_webpage(url, video_id)
 
-        embedded_data_raw = self._html_search_regex(r'id\s*=\s*"embedded-data"[^>]*data-props\s*=\s*"([^"]+)"',
+        embedded_data_raw = self._html_search_regex(self._EMBEDDED_DATA_RE,
             webpage, 'embedded-data', default=None, fatal=False)
 
         if embedded_data_raw is not None:
@@ -873,7 +962,7 @@ class NiconicoLiveIE(InfoExtractor):
 
             self.to_screen('Detected post-March 2019 HLS-based stream')
 
-            embedded_data = json.loads(embedded_data_raw)
+            embedded_data = _json_loads(embedded_data_raw)
 
             websocket_url = embedded_data['site']['relive']['webSocketUrl']
             best_quality = embedded_data['program']['stream']['maxQuality']
@@ -906,10 +995,16 @@ class NiconicoLiveIE(InfoExtractor):
 
             self.to_screen('Detected pre-March 2019 RTMP-based timeshift stream')
 
-            playerstatus_raw = self._html_search_regex(r'"value_by_gps"\s*:\s*"([^"]+)"',
+            playerstatus_raw = self._html_search_regex(self._PLAYER_STATUS_RE,
                                             webpage, 'entries')
 
-            playerstatus_xml = self._parse_xml(compat_urlparse.unquote(playerstatus_raw), video_id)
+            # the percent-decoded bytes go straight to the parser, rather than being
+            # decoded to a str that _parse_xml would only encode again
+            try:
+                playerstatus_xml = compat_etree_fromstring(
+                    compat_urllib_parse_unquote_to_bytes(playerstatus_raw))
+            except compat_xml_parse_error as ve:
+                raise ExtractorError('%s: Failed to parse XML ' % video_id, cause=ve)
 
             rtmp_url = xpath_text(playerstatus_xml, './rtmp/url')
             rtmp_ticket = xpath_text(playerstatus_xml, './rtmp/ticket')
@@ -917,24 +1012,21 @@ class NiconicoLiveIE(InfoExtractor):
             if rtmp_url is None or rtmp_url == '':
                 raise ExtractorError('Unable to find stream media URL. Is the stream private or unavailable?', expected=True)
 
-            que_sheet_nodes = playerstatus_xml.findall('./stream/quesheet/que')
-            que_sheet = list(map(lambda x: x.text, que_sheet_nodes))
-
             published_urls = {}
             raw_formats = {}
 
-            for que in que_sheet:
+            # only the leading words of each que are used, so the rest is never split
+            for que_node in playerstatus_xml.iterfind('./stream/quesheet/que'):
+                que = que_node.text
                 if que.startswith("/publish"):
-                    split_publish = que.split(' ')
+                    split_publish = que.split(' ', 3)
                     published_urls[split_publish[1]] = split_publish[2]
                 
                 elif que.startswith("/play"):
-                    split_play = que.split(' ')[1].split(',')
+                    split_play = que.split(' ', 2)[1].split(',')
 
                     for raw_format in split_play:
-                        split_format = raw_format.split(':')
-                        
-                        raw_formats[split_format[0]] = split_format[-1]
+                        raw_formats[raw_format.partition(':')[0]] = raw_format.rpartition(':')[2]
 
 
             title = xpath_text(playerstatus_xml, './stream/title')
@@ -1002,6 +1094,7 @@ class NiconicoLiveIE(InfoExtractor):
 
 import argparse
 import calendar
+import functools
 import gettext
 import io
 import json
@@ -1012,7 +1105,11 @@ import random
 import re
 import sys
 import time
-import xml.dom.minidom
+
+try:
+    import lxml.etree as ElementTree
+except ImportError:
+    import xml.etree.ElementTree as ElementTree
 
 #gettext.install('danmaku2ass', os.path.join(os.path.dirname(os.path.abspath(os.path.realpath(sys.argv[0] or 'locale'))), 'locale'))
 
@@ -1070,38 +1167,59 @@ def EOFAsNone(function):
 #
 
 
+NiconicoColorMap = {'red': 0xff0000, 'pink': 0xff8080, 'orange': 0xffcc00, 'yellow': 0xffff00, 'green': 0x00ff00, 'cyan': 0x00ffff, 'blue': 0x0000ff, 'purple': 0xc000ff, 'black': 0x000000, 'niconicowhite': 0xcccc99, 'white2': 0xcccc99, 'truered': 0xcc0033, 'red2': 0xcc0033, 'passionorange': 0xff6600, 'orange2': 0xff6600, 'madyellow': 0x999900, 'yellow2': 0x999900, 'elementalgreen': 0x00cc66, 'green2': 0x00cc66, 'marineblue': 0x33ffcc, 'blue2': 0x33ffcc, 'nobleviolet': 0x6633cc, 'purple2': 0x6633cc}
+
+# What each word of a Niconico comment's mail attribute sets: (kind, value),
+# where a size is given as a multiple of the default font size.
+NiconicoMailStyleMap = {'ue': ('pos', 1), 'shita': ('pos', 2), 'big': ('size', 1.44), 'small': ('size', 0.64)}
+NiconicoMailStyleMap.update((name, ('color', color)) for name, color in NiconicoColorMap.items())
+
+
+def IterElements(f, tag):
+    # Yields each <tag> element as soon as the parser has read all of it, then
+    # drops everything read so far, so the whole document is never in memory.
+    # lxml reads bytes only and rejects text that declares an encoding, so a
+    # text source, e.g. a StringIO, is read through FilterBadChars as UTF-8.
+    if isinstance(f, io.TextIOBase):
+        f = FilterBadChars(f)
+    context = iter(ElementTree.iterparse(f, events=('start', 'end')))
+    _, root = next(context)
+    for event, elem in context:
+        if event == 'end' and elem.tag == tag:
+            yield elem
+            root.clear()
+
+
 def ReadCommentsNiconico(f, fontsize):
-    NiconicoColorMap = {'red': 0xff0000, 'pink': 0xff8080, 'orange': 0xffcc00, 'yellow': 0xffff00, 'green': 0x00ff00, 'cyan': 0x00ffff, 'blue': 0x0000ff, 'purple': 0xc000ff, 'black': 0x000000, 'niconicowhite': 0xcccc99, 'white2': 0xcccc99, 'truered': 0xcc0033, 'red2': 0xcc0033, 'passionorange': 0xff6600, 'orange2': 0xff6600, 'madyellow': 0x999900, 'yellow2': 0x999900, 'elementalgreen': 0x00cc66, 'green2': 0x00cc66, 'marineblue': 0x33ffcc, 'blue2': 0x33ffcc, 'nobleviolet': 0x6633cc, 'purple2': 0x6633cc}
-    dom = xml.dom.minidom.parse(f)
-    comment_element = dom.getElementsByTagName('chat')
-    for comment in comment_element:
+    for comment in IterElements(f, 'chat'):
         try:
-            c = str(comment.childNodes[0].wholeText)
+            c = comment.text
             if c.startswith('/'):
                 continue  # ignore advanced comments
+            attrib = comment.attrib
             pos = 0
             color = 0xffffff
             size = fontsize
-            for mailstyle in str(comment.getAttribute('mail')).split():
-                if mailstyle == 'ue':
-                    pos = 1
-                elif mailstyle == 'shita':
-                    pos = 2
-                elif mailstyle == 'big':
-                    size = fontsize * 1.44
-                elif mailstyle == 'small':
-                    size = fontsize * 0.64
-                elif mailstyle in NiconicoColorMap:
-                    color = NiconicoColorMap[mailstyle]
-            yield (max(int(comment.getAttribute('vpos')), 0) * 0.01, int(comment.getAttribute('date')), int(comment.getAttribute('no')), c, pos, color, size, (c.count('\n') + 1) * size, CalculateLength(c) * size)
-        except (AssertionError, AttributeError, IndexError, TypeError, ValueError):
-            # logging.warning(_('Invalid comment: %s') % comment.toxml())
+            for mailstyle in attrib.get('mail', '').split():
+                style = NiconicoMailStyleMap.get(mailstyle)
+                if style is None:
+                    continue
+                kind, value = style
+                if kind == 'pos':
+                    pos = value
+                elif kind == 'size':
+                    size = fontsize * value
+                else:
+                    color = value
+            lines, length = CalculateLinesAndLength(c)
+            yield (max(int(attrib['vpos']), 0) * 0.01, int(attrib['date']), int(attrib['no']), c, pos, color, size, lines * size, length * size)
+        except (AssertionError, AttributeError, IndexError, KeyError, TypeError, ValueError):
+            # logging.warning(_('Invalid comment: %s') % ElementTree.tostring(comment))
             continue
 
 
 def ReadCommentsNiconicoJson(f, fontsize):
-    NiconicoColorMap = {'red': 0xff0000, 'pink': 0xff8080, 'orange': 0xffcc00, 'yellow': 0xffff00, 'green': 0x00ff00, 'cyan': 0x00ffff, 'blue': 0x0000ff, 'purple': 0xc000ff, 'black': 0x000000, 'niconicowhite': 0xcccc99, 'white2': 0xcccc99, 'truered': 0xcc0033, 'red2': 0xcc0033, 'passionorange': 0xff6600, 'orange2': 0xff6600, 'madyellow': 0x999900, 'yellow2': 0x999900, 'elementalgreen': 0x00cc66, 'green2': 0x00cc66, 'marineblue': 0x33ffcc, 'blue2': 0x33ffcc, 'nobleviolet': 0x6633cc, 'purple2': 0x6633cc}
-    dom = json.load(f)
+    dom = _json_loads(f.read())
 
     for comment_dom in dom:
         if ('chat' not in comment_dom):
@@ -1116,43 +1234,43 @@ def ReadCommentsNiconicoJson(f, fontsize):
             color = 0xffffff
             size = fontsize
             for mailstyle in comment['mail'].split():
-                if mailstyle == 'ue':
-                    pos = 1
-                elif mailstyle == 'shita':
-                    pos = 2
-                elif mailstyle == 'big':
-                    size = fontsize * 1.44
-                elif mailstyle == 'small':
-                    size = fontsize * 0.64
-                elif mailstyle in NiconicoColorMap:
-                    color = NiconicoColorMap[mailstyle]
+                style = NiconicoMailStyleMap.get(mailstyle)
+                if style is None:
+                    continue
+                kind, value = style
+                if kind == 'pos':
+                    pos = value
+                elif kind == 'size':
+                    size = fontsize * value
+                else:
+                    color = value
             
-            yield (max(comment['vpos'], 0) * 0.01, comment['date'], comment['no'], c, pos, color, size, (c.count('\n') + 1) * size, CalculateLength(c) * size)
+            lines, length = CalculateLinesAndLength(c)
+            yield (max(comment['vpos'], 0) * 0.01, comment['date'], comment['no'], c, pos, color, size, lines * size, length * size)
         except (AssertionError, AttributeError, IndexError, TypeError, ValueError, KeyError):
             # logging.warning(_('Invalid comment: %s') % json.dumps(comment))
             continue
 
 
 def ReadCommentsBilibili(f, fontsize):
-    dom = xml.dom.minidom.parse(f)
-    comment_element = dom.getElementsByTagName('d')
-    for i, comment in enumerate(comment_element):
+    for i, comment in enumerate(IterElements(f, 'd')):
         try:
-            p = str(comment.getAttribute('p')).split(',')
+            p = comment.get('p', '').split(',')
             assert len(p) >= 5
             assert p[1] in ('1', '4', '5', '6', '7', '8')
-            if comment.childNodes.length > 0:
+            if comment.text is not None:
                 if p[1] in ('1', '4', '5', '6'):
-                    c = str(comment.childNodes[0].wholeText).replace('/n', '\n')
+                    c = comment.text.replace('/n', '\n')
                     size = int(p[2]) * fontsize / 25.0
-                    yield (float(p[0]), int(p[4]), i, c, {'1': 0, '4': 2, '5': 1, '6': 3}[p[1]], int(p[3]), size, (c.count('\n') + 1) * size, CalculateLength(c) * size)
+                    lines, length = CalculateLinesAndLength(c)
+                    yield (float(p[0]), int(p[4]), i, c, {'1': 0, '4': 2, '5': 1, '6': 3}[p[1]], int(p[3]), size, lines * size, length * size)
                 elif p[1] == '7':  # positioned comment
-                    c = str(comment.childNodes[0].wholeText)
+                    c = comment.text
                     yield (float(p[0]), int(p[4]), i, c, 'bilipos', int(p[3]), int(p[2]), 0, 0)
                 elif p[1] == '8':
                     pass  # ignore scripted comment
         except (AssertionError, AttributeError, IndexError, TypeError, ValueError):
-            # logging.warning(_('Invalid comment: %s') % comment.toxml())
+            # logging.warning(_('Invalid comment: %s') % ElementTree.tostring(comment))
             continue
 
 CommentFormatMap = {'Niconico': ReadCommentsNiconico, 'NiconicoJson': ReadCommentsNiconicoJson, 'Bilibili': ReadCommentsBilibili}
@@ -1180,30 +1298,38 @@ def WriteCommentBilibiliPositioned(f, c, width, height, styleid):
             return GetPosition(InputPos, isHeight)
 
     try:
-        comment_args = safe_list(json.loads(c[3]))
+        comment_args = _json_loads(c[3])
+        if not isinstance(comment_args, list):
+            comment_args = list(comment_args)
+        # trailing arguments may be left out, and take their defaults
+        nargs = len(comment_args)
         text = ASSEscape(str(comment_args[4]).replace('/n', '\n'))
-        from_x = comment_args.get(0, 0)
-        from_y = comment_args.get(1, 0)
-        to_x = comment_args.get(7, from_x)
-        to_y = comment_args.get(8, from_y)
+        from_x = comment_args[0]
+        from_y = comment_args[1]
+        to_x = comment_args[7] if nargs > 7 else from_x
+        to_y = comment_args[8] if nargs > 8 else from_y
         from_x = GetPosition(from_x, False)
         from_y = GetPosition(from_y, True)
         to_x = GetPosition(to_x, False)
         to_y = GetPosition(to_y, True)
-        alpha = safe_list(str(comment_args.get(2, '1')).split('-'))
-        from_alpha = float(alpha.get(0, 1))
-        to_alpha = float(alpha.get(1, from_alpha))
+        # "from-to", or a single alpha for both
+        from_alpha, has_to_alpha, to_alpha = str(comment_args[2]).partition('-')
+        from_alpha = float(from_alpha)
+        to_alpha = float(to_alpha.partition('-')[0]) if has_to_alpha else from_alpha
         from_alpha = 255 - round(from_alpha * 255)
         to_alpha = 255 - round(to_alpha * 255)
-        rotate_z = int(comment_args.get(5, 0))
-        rotate_y = int(comment_args.get(6, 0))
-        lifetime = float(comment_args.get(3, 4500))
-        duration = int(comment_args.get(9, lifetime * 1000))
-        delay = int(comment_args.get(10, 0))
-        fontface = comment_args.get(12)
-        isborder = comment_args.get(11, 'true')
+        rotate_z = int(comment_args[5]) if nargs > 5 else 0
+        rotate_y = int(comment_args[6]) if nargs > 6 else 0
+        lifetime = float(comment_args[3])
+        duration = int(comment_args[9]) if nargs > 9 else int(lifetime * 1000)
+        delay = int(comment_args[10]) if nargs > 10 else 0
+        fontface = comment_args[12] if nargs > 12 else None
+        isborder = comment_args[11] if nargs > 11 else 'true'
         from_rotarg = ConvertFlashRotation(rotate_y, rotate_z, from_x, from_y, width, height)
-        to_rotarg = ConvertFlashRotation(rotate_y, rotate_z, to_x, to_y, width, height)
+        if (to_x, to_y) == (from_x, from_y):
+            to_rotarg = from_rotarg
+        else:
+            to_rotarg = ConvertFlashRotation(rotate_y, rotate_z, to_x, to_y, width, height)
         styles = ['\\org(%d, %d)' % (width / 2, height / 2)]
         if from_rotarg[0:2] == to_rotarg[0:2]:
             styles.append('\\pos(%.0f, %.0f)' % (from_rotarg[0:2]))
@@ -1275,23 +1401,28 @@ def ConvertFlashRotation(rotY, rotZ, X, Y, width, height):
         return 180 - ((180 - deg) % 360)
     rotY = WrapAngle(rotY)
     rotZ = WrapAngle(rotZ)
+    if rotY == 0 and rotZ == 0:
+        # Nothing is rotated, so only the scaling about the centre below is left,
+        # with a scale of exactly 1
+        return ((X - width / 2) + width / 2, (Y - height / 2) + height / 2, 0, 0, 0, 100.0, 100.0)
     if rotY in (90, -90):
         rotY -= 1
+    # each angle's sine and cosine is taken once, and reused in every term below
+    sinY = math.sin(rotY * (math.pi / 180.0))
+    cosY = math.cos(rotY * (math.pi / 180.0))
+    sinZ = math.sin(rotZ * (math.pi / 180.0))
+    cosZ = math.cos(rotZ * (math.pi / 180.0))
     if rotY == 0 or rotZ == 0:
         outX = 0
         outY = -rotY  # Positive value means clockwise in Flash
         outZ = -rotZ
-        rotY *= math.pi / 180.0
-        rotZ *= math.pi / 180.0
     else:
-        rotY *= math.pi / 180.0
-        rotZ *= math.pi / 180.0
-        outY = math.atan2(-math.sin(rotY) * math.cos(rotZ), math.cos(rotY)) * 180 / math.pi
-        outZ = math.atan2(-math.cos(rotY) * math.sin(rotZ), math.cos(rotZ)) * 180 / math.pi
-        outX = math.asin(math.sin(rotY) * math.sin(rotZ)) * 180 / math.pi
-    trX = (X * math.cos(rotZ) + Y * math.sin(rotZ)) / math.cos(rotY) + (1 - math.cos(rotZ) / math.cos(rotY)) * width / 2 - math.sin(rotZ) / math.cos(rotY) * height / 2
-    trY = Y * math.cos(rotZ) - X * math.sin(rotZ) + math.sin(rotZ) * width / 2 + (1 - math.cos(rotZ)) * height / 2
-    trZ = (trX - width / 2) * math.sin(rotY)
+        outY = math.atan2(-sinY * cosZ, cosY) * 180 / math.pi
+        outZ = math.atan2(-cosY * sinZ, cosZ) * 180 / math.pi
+        outX = math.asin(sinY * sinZ) * 180 / math.pi
+    trX = (X * cosZ + Y * sinZ) / cosY + (1 - cosZ / cosY) * width / 2 - sinZ / cosY * height / 2
+    trY = Y * cosZ - X * sinZ + sinZ * width / 2 + (1 - cosZ) * height / 2
+    trZ = (trX - width / 2) * sinY
     FOV = width * math.tan(2 * math.pi / 9.0) / 2
     try:
         scaleXY = FOV / (FOV + trZ)
@@ -1312,9 +1443,16 @@ def ProcessComments(comments, f, width, height, bottomReserved, fontface, fontsi
     styleid = 'Danmaku2ASS_%04x' % random.randint(0, 0xffff)
     WriteASSHead(f, width, height, fontface, fontsize, alpha, styleid)
     rows = [[None] * (height - bottomReserved + 1) for i in range(4)]
+    # Dialogue lines are collected in memory and handed to f a thousand
+    # comments at a time, rather than with one f.write per comment.
+    buf = io.StringIO()
     for idx, i in enumerate(comments):
         if progress_callback and idx % 1000 == 0:
             progress_callback(idx, len(comments))
+        if idx % 1000 == 999:
+            f.write(buf.getvalue())
+            buf.seek(0)
+            buf.truncate()
         if isinstance(i[4], int):
             if filter_regex and filter_regex.search(i[3]):
                 continue
@@ -1324,7 +1462,7 @@ def ProcessComments(comments, f, width, height, bottomReserved, fontface, fontsi
                 freerows = TestFreeRows(rows, i, row, width, height, bottomReserved, duration_marquee, duration_still)
                 if freerows >= i[7]:
                     MarkCommentRow(rows, i, row)
-                    WriteComment(f, i, row, width, height, bottomReserved, fontsize, duration_marquee, duration_still, styleid)
+                    WriteComment(buf, i, row, width, height, bottomReserved, fontsize, duration_marquee, duration_still, styleid)
                     break
                 else:
                     row += freerows or 1
@@ -1332,38 +1470,47 @@ def ProcessComments(comments, f, width, height, bottomReserved, fontface, fontsi
                 if not reduced:
                     row = FindAlternativeRow(rows, i, height, bottomReserved)
                     MarkCommentRow(rows, i, row)
-                    WriteComment(f, i, row, width, height, bottomReserved, fontsize, duration_marquee, duration_still, styleid)
+                    WriteComment(buf, i, row, width, height, bottomReserved, fontsize, duration_marquee, duration_still, styleid)
         elif i[4] == 'bilipos':
-            WriteCommentBilibiliPositioned(f, i, width, height, styleid)
+            WriteCommentBilibiliPositioned(buf, i, width, height, styleid)
         else:
             pass
             # logging.warning(_('Invalid comment: %r') % i[3])
+    f.write(buf.getvalue())
+    buf.close()
     if progress_callback:
         progress_callback(len(comments), len(comments))
 
 
 def TestFreeRows(rows, c, row, width, height, bottomReserved, duration_marquee, duration_still):
+    # This is the innermost loop of the layout, run for every row a comment is
+    # tried at, so everything it reads from c and rows is bound to locals first.
+    # A row holds a reference to the comment occupying it, so a change of
+    # occupant is an identity test rather than a tuple comparison.
     res = 0
     rowmax = height - bottomReserved
     targetRow = None
+    posrows = rows[c[4]]
+    start = c[0]
+    needed = c[7]
     if c[4] in (1, 2):
-        while row < rowmax and res < c[7]:
-            if targetRow != rows[c[4]][row]:
-                targetRow = rows[c[4]][row]
-                if targetRow and targetRow[0] + duration_still > c[0]:
+        while row < rowmax and res < needed:
+            if targetRow is not posrows[row]:
+                targetRow = posrows[row]
+                if targetRow and targetRow[0] + duration_still > start:
                     break
             row += 1
             res += 1
     else:
         try:
-            thresholdTime = c[0] - duration_marquee * (1 - width / (c[8] + width))
+            thresholdTime = start - duration_marquee * (1 - width / (c[8] + width))
         except ZeroDivisionError:
-            thresholdTime = c[0] - duration_marquee
-        while row < rowmax and res < c[7]:
-            if targetRow != rows[c[4]][row]:
-                targetRow = rows[c[4]][row]
+            thresholdTime = start - duration_marquee
+        while row < rowmax and res < needed:
+            if targetRow is not posrows[row]:
+                targetRow = posrows[row]
                 try:
-                    if targetRow and (targetRow[0] > thresholdTime or targetRow[0] + targetRow[8] * duration_marquee / (targetRow[8] + width) > c[0]):
+                    if targetRow and (targetRow[0] > thresholdTime or targetRow[0] + targetRow[8] * duration_marquee / (targetRow[8] + width) > start):
                         break
                 except ZeroDivisionError:
                     pass
@@ -1383,11 +1530,11 @@ def FindAlternativeRow(rows, c, height, bottomReserved):
 
 
 def MarkCommentRow(rows, c, row):
-    try:
-        for i in range(row, row + math.ceil(c[7])):
-            rows[c[4]][i] = c
-    except IndexError:
-        pass
+    # one slice assignment, cut short at the bottom of the stage
+    posrows = rows[c[4]]
+    end = min(row + math.ceil(c[7]), len(posrows))
+    if end > row:
+        posrows[row:end] = [c] * (end - row)
 
 
 def WriteASSHead(f, width, height, fontface, fontsize, alpha, styleid):
@@ -1417,26 +1564,29 @@ Format: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text
 
 def WriteComment(f, c, row, width, height, bottomReserved, fontsize, duration_marquee, duration_still, styleid):
     text = ASSEscape(c[3])
-    styles = []
     if c[4] == 1:
-        styles.append('\\an8\\pos(%(halfwidth)d, %(row)d)' % {'halfwidth': width / 2, 'row': row})
+        position = '\\an8\\pos(%d, %d)' % (width / 2, row)
         duration = duration_still
     elif c[4] == 2:
-        styles.append('\\an2\\pos(%(halfwidth)d, %(row)d)' % {'halfwidth': width / 2, 'row': ConvertType2(row, height, bottomReserved)})
+        position = '\\an2\\pos(%d, %d)' % (width / 2, ConvertType2(row, height, bottomReserved))
         duration = duration_still
     elif c[4] == 3:
-        styles.append('\\move(%(neglen)d, %(row)d, %(width)d, %(row)d)' % {'width': width, 'row': row, 'neglen': -math.ceil(c[8])})
+        position = '\\move(%d, %d, %d, %d)' % (-math.ceil(c[8]), row, width, row)
         duration = duration_marquee
     else:
-        styles.append('\\move(%(width)d, %(row)d, %(neglen)d, %(row)d)' % {'width': width, 'row': row, 'neglen': -math.ceil(c[8])})
+        position = '\\move(%d, %d, %d, %d)' % (width, row, -math.ceil(c[8]), row)
         duration = duration_marquee
-    if not (-1 < c[6] - fontsize < 1):
-        styles.append('\\fs%.0f' % c[6])
-    if c[5] != 0xffffff:
-        styles.append('\\c&H%s&' % ConvertColor(c[5]))
-        if c[5] == 0x000000:
-            styles.append('\\3c&HFFFFFF&')
-    f.write('Dialogue: 2,%(start)s,%(end)s,%(styleid)s,,0000,0000,0000,,{%(styles)s}%(text)s\n' % {'start': ConvertTimestamp(c[0]), 'end': ConvertTimestamp(c[0] + duration), 'styles': ''.join(styles), 'text': text, 'styleid': styleid})
+    if -1 < c[6] - fontsize < 1:
+        size_style = ''
+    else:
+        size_style = '\\fs%.0f' % c[6]
+    if c[5] == 0xffffff:
+        color_style = ''
+    elif c[5] == 0x000000:
+        color_style = '\\c&H000000&\\3c&HFFFFFF&'
+    else:
+        color_style = '\\c&H%s&' % ConvertColor(c[5])
+    f.write('Dialogue: 2,%s,%s,%s,,0000,0000,0000,,{%s%s%s}%s\n' % (ConvertTimestamp(c[0]), ConvertTimestamp(c[0] + duration), styleid, position, size_style, color_style, text))
 
 
 def ASSEscape(s):
@@ -1456,14 +1606,21 @@ def CalculateLength(s):
     return max(map(len, s.split('\n')))  # May not be accurate
 
 
+def CalculateLinesAndLength(s):
+    # s.count('\n') + 1 and CalculateLength(s), from a single split
+    lines = s.split('\n')
+    return len(lines), max(map(len, lines))
+
+
 def ConvertTimestamp(timestamp):
-    timestamp = round(timestamp * 100.0)
+    timestamp = round(timestamp * 100.0)  # round() of a float is already an int
     hour, minute = divmod(timestamp, 360000)
     minute, second = divmod(minute, 6000)
     second, centsecond = divmod(second, 100)
-    return '%d:%02d:%02d.%02d' % (int(hour), int(minute), int(second), int(centsecond))
+    return '%d:%02d:%02d.%02d' % (hour, minute, second, centsecond)
 
 
+@functools.lru_cache(maxsize=256)  # comments use only a handful of colors
 def ConvertColor(RGB, width=1280, height=576):
     if RGB == 0x000000:
         return '000000'
@@ -1475,7 +1632,6 @@ def ConvertColor(RGB, width=1280, height=576):
     if width < 1280 and height < 576:
         return '%02X%02X%02X' % (B, G, R)
     else:  # VobSub always uses BT.601 colorspace, convert to BT.709
-        ClipByte = lambda x: 255 if x > 255 else 0 if x < 0 else round(x)
         return '%02X%02X%02X' % (
             ClipByte(R * 0.00956384088080656 + G * 0.03217254540203729 + B * 0.95826361371715607),
             ClipByte(R * -0.10493933142075390 + G * 1.17231478191855154 + B * -0.06737545049779757),
@@ -1483,6 +1639,10 @@ def ConvertColor(RGB, width=1280, height=576):
         )
 
 
+def ClipByte(x):
+    return 255 if x > 255 else 0 if x < 0 else round(x)
+
+
 def ConvertType2(row, height, bottomReserved):
     return height - bottomReserved - row
 
@@ -1496,19 +1656,19 @@ def ConvertToFile(filename_or_file, *args, **kwargs):
         return filename_or_file
 
 
-def FilterBadChars(f):
-    s = f.read()
-    s = re.sub('[\\x00-\\x08\\x0b\\x0c\\x0e-\\x1f]', '\ufffd', s)
-    return io.StringIO(s)
+BadCharsRegex = re.compile('[\\x00-\\x08\\x0b\\x0c\\x0e-\\x1f]')
 
 
-class safe_list(list):
+class FilterBadChars(object):
+    # Replaces the bad characters in whatever is read from f, as it is read,
+    # so a parser reading in chunks never needs a filtered copy of the whole file.
+    # The text is handed on as UTF-8 bytes: lxml's iterparse only reads bytes.
 
-    def get(self, index, default=None):
-        try:
-            return self[index]
-        except IndexError:
-            return default
+    def __init__(self, f):
+        self.f = f
+
+    def read(self, size=-1):
+        return BadCharsRegex.sub('\ufffd', self.f.read(size)).encode('utf-8')
 
 
 def export(func):
@@ -1539,6 +1699,17 @@ def Danmaku2ASS(input_files, input_format, output_file, stage_width, stage_heigh
         if output_file and fo != output_file:
             fo.close()
 
+def ReadCommentsFile(filename_or_file, input_format, font_size):
+    with ConvertToFile(filename_or_file, 'r', encoding='utf-8', errors='replace') as f:
+        CommentProcessor = CommentFormatMap.get(input_format)
+        if not CommentProcessor:
+            raise ValueError(
+                _('Unknown comment file format: %s') % input_format
+            )
+        # FilterBadChars filters the file as it is read, no need to copy it to memory first
+        return list(CommentProcessor(FilterBadChars(f), font_size))
+
+
 def ReadComments(input_files, input_format, font_size=25.0, progress_callback=None):
     if isinstance(input_files, bytes):
         input_files = str(bytes(input_files).decode('utf-8', 'replace'))
@@ -1547,18 +1718,20 @@ def ReadComments(input_files, input_format, font_size=25.0, progress_callback=No
     else:
         input_files = list(input_files)
     comments = []
-    for idx, i in enumerate(input_files):
-        if progress_callback:
-            progress_callback(idx, len(input_files))
-        with ConvertToFile(i, 'r', encoding='utf-8', errors='replace') as f:
-            s = f.read()
-            str_io = io.StringIO(s)
-            CommentProcessor = CommentFormatMap.get(input_format)
-            if not CommentProcessor:
-                raise ValueError(
-                    _('Unknown comment file format: %s') % input_format
-                )
-            comments.extend(CommentProcessor(FilterBadChars(str_io), font_size))
+    if len(input_files) > 1 and all(isinstance(i, (str, bytes)) for i in input_files):
+        # Parsing is CPU bound and the files are independent, so several named
+        # files are read in worker processes; open files can't be sent to them.
+        with concurrent.futures.ProcessPoolExecutor() as executor:
+            parts = executor.map(ReadCommentsFile, input_files, [input_format] * len(input_files), [font_size] * len(input_files))
+            for idx, part in enumerate(parts):
+                if progress_callback:
+                    progress_callback(idx, len(input_files))
+                comments.extend(part)
+    else:
+        for idx, i in enumerate(input_files):
+            if progress_callback:
+                progress_callback(idx, len(input_files))
+            comments.extend(ReadCommentsFile(i, input_format, font_size))
     if progress_callback:
         progress_callback(len(input_files), len(input_files))
     comments.sort()